@@ -5,9 +5,12 @@ import os
 import requests
 import secrets
 import socket
-import time
 import firecrest
-from firecrest.FirecrestException import HeaderException
+from firecrestspawner.spawner import check_spawner_config
+from firecrestspawner.spawner import SlurmSpawner
+from firecrestspawner.spawner import prefetch_userinfo
+# can be set as `customStateGetHost` in the chart's values
+from firecrestspawner.spawner import get_node_ip_from_output  # noqa: F401
 from oauthenticator.generic import GenericOAuthenticator
 
 
@@ -27,34 +30,6 @@ def gen_hex_string(hex_strings_file, num_bytes=32, num_hex_strings=4):
     return hex_strings
 
 
-async def get_node_ip_from_output(spawner):
-    """Custom function to fetch the ip of the node where
-    the single-user server is running from the first line
-    of the job's output file.
-
-    This expects that `hostname -i` is called at the begining
-    of the job.
-
-    This function is called by the spawner once the job has started.
-    The spawner class will pass `self` as the `spawner` argument.
-    """
-    while True:
-        try:
-            spawner.log.info(spawner.job['job_file_out'])
-            client = await spawner.get_firecrest_client()
-            spawner.log.info("firecREST: Running `client.head` "
-                             "to fetch the ip")
-            ip = await client.head(spawner.host,
-                                   spawner.job['job_file_out'],
-                                   lines='1')
-            return ip.strip()
-        except HeaderException as e:
-            spawner.log.info("Spawner looking for the host IP in "
-                             "the job's output")
-            spawner.log.info(f"Job output file not available yet: {e}")
-            time.sleep(2)
-
-
 c = get_config()
 
 # Admin users can start and access user servers
@@ -119,6 +94,10 @@ c.Authenticator.auth_refresh_age = 250
 c.Authenticator.enable_auth_state = True
 c.CryptKeeper.keys = gen_hex_string("/home/juhu/hex_strings_crypt.txt")
 
+# request the user's groups in the background at login,
+# they are needed to set the default account when spawning
+c.Authenticator.post_auth_hook = prefetch_userinfo
+
 c.JupyterHub.authenticator_class = GenericOAuthenticator
 c.GenericOAuthenticator.client_id = os.environ.get('KC_CLIENT_ID', '<client-id>')
 c.GenericOAuthenticator.client_secret = os.environ.get('KC_CLIENT_SECRET', '<client-secret>')
@@ -188,6 +167,7 @@ echo "jupyterhub-singleuser ended gracefully"
 {{`{{epilogue}}`}}
 """
 c.Spawner.custom_state_gethost = {{ .Values.config.spawner.customStateGetHost }}
+c.Spawner.singleuser_callback_address = '{{ .Values.config.spawner.singleuserCallbackAddress }}'
 c.Spawner.cmd = '{{ .Values.config.spawner.cmd }}'
 c.Spawner.http_timeout = {{ .Values.config.spawner.http_timeout }}
 c.Spawner.options_form = """
@@ -246,3 +226,7 @@ c.JupyterHub.template_vars = {
 }
 
 {{ .Values.config.extraConfig }}
+
+# Validate the configuration of the spawner (e.g. the syntax of the batch
+# script template) when the hub starts instead of on the first spawn
+check_spawner_config(c, SlurmSpawner)
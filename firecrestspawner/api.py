@@ -1,9 +1,90 @@
+import asyncio
 import json
 from tornado import web
+from traitlets import TraitError
 from jupyterhub.apihandlers import APIHandler, default_handlers
+from jupyterhub.scopes import needs_scope
+
+
+#: Spawner traits that the single-user server can set
+REPORTABLE_TRAITS = frozenset({"port", "node_ip", "node_hostname"})
+
+#: Traits ignored if they are reported by the job of a previous spawn
+NODE_TRAITS = frozenset({"node_ip", "node_hostname"})
+
+
+def apply_spawner_updates(spawner, data, log) -> dict:
+    """Set the traits reported by the single-user server
+
+    ``data`` is either a dictionary or a list of dictionaries applied in
+    order. Besides the traits in ``REPORTABLE_TRAITS``, each of them may have
+    the ``job_id`` of the job reporting the values, whose node is ignored
+    if it's not the spawner's current job. All the values are validated
+    before setting any of them. A report of the current job is recorded in
+    the spawn timeline of the spawner, if it has one.
+
+    Returns the values that have been set.
+    """
+    updates = data if isinstance(data, list) else [data]
+    values = {}
+    previous_spawn = False
+    for update in updates:
+        if not isinstance(update, dict):
+            raise web.HTTPError(400, "Updates must be JSON objects")
+
+        update = dict(update)
+        job_id = update.pop("job_id", None)
+        unknown = update.keys() - REPORTABLE_TRAITS
+        if unknown:
+            raise web.HTTPError(
+                400, f"Unknown keys: {', '.join(sorted(unknown))}"
+            )
+
+        if job_id and spawner.job_id and str(job_id) != spawner.job_id:
+            # the request comes from a job of a previous spawn
+            log.warning(f"Ignoring node reported by job {job_id}, "
+                        f"expected job {spawner.job_id}")
+            previous_spawn = True
+            for key in NODE_TRAITS:
+                update.pop(key, None)
+
+        values.update(update)
+
+    try:
+        # the changes are reverted if any of the values isn't valid
+        with spawner.hold_trait_notifications():
+            for key, value in values.items():
+                setattr(spawner, key, value)
+    except TraitError as e:
+        raise web.HTTPError(400, f"Invalid value: {e}")
+
+    record_server_report = getattr(spawner, "record_server_report", None)
+    if record_server_report is not None and not previous_spawn:
+        record_server_report()
+
+    return values
 
 
 class FireCRESTSpawnerAPIHandler(APIHandler):
+    def find_spawner(self, user):
+        """Returns the spawner of the server authenticated by the request's
+        token"""
+        # imported here since the package is also imported on the compute
+        # nodes by ``firecrestspawner-singleuser``
+        from firecrestspawner.spawner import FirecRESTSpawnerBase
+
+        token = self.get_auth_token()
+        spawner = FirecRESTSpawnerBase.find_by_api_token(token)
+        if spawner is not None and spawner.user.name == user.name:
+            return spawner
+
+        # spawners of other classes aren't indexed
+        for s in user.spawners.values():
+            if s.api_token == token:
+                return s
+
+        return None
+
     @web.authenticated
     def post(self):
         """POST set user spawner data"""
@@ -14,20 +95,94 @@ class FireCRESTSpawnerAPIHandler(APIHandler):
             # Previous jupyterhub, 0.9.4 and before.
             user = self.get_current_user()
 
-        token = self.get_auth_token()
-        spawner = None
-        for s in user.spawners.values():
-            if s.api_token == token:
-                spawner = s
-                break
+        spawner = self.find_spawner(user)
+        if spawner is None:
+            raise web.HTTPError(404, "No server uses this token")
 
-        data = self.get_json_body()
-        for key, value in data.items():
-            if hasattr(spawner, key):
-                setattr(spawner, key, value)
+        apply_spawner_updates(spawner, self.get_json_body(), self.log)
 
         self.finish(json.dumps({"message": "FirecRESTSpawner data configured"}))
         self.set_status(201)
 
 
+class FireCRESTSpawnerCancelAPIHandler(APIHandler):
+    @needs_scope("servers")
+    async def post(self):
+        """POST stop several servers, cancelling their jobs in bulk
+
+        The body is ``{"servers": ["user", "user/server", ...]}``. The jobs
+        are cancelled with ``FirecRESTSpawnerBase.cancel_jobs`` before
+        stopping the servers, whose ``stop`` then only confirms that the
+        jobs are gone. Servers whose job couldn't be cancelled are left
+        running and reported with the ``failed`` status. Servers that fail
+        to stop are reported with the ``stop_failed`` status. Both include
+        the ``error``.
+        """
+        from firecrestspawner.spawner import FirecRESTSpawnerBase
+
+        data = self.get_json_body() or {}
+        names = data.get("servers")
+        if (not isinstance(names, list) or
+                not all(isinstance(name, str) for name in names)):
+            raise web.HTTPError(400, "servers must be a list of server names")
+
+        has_access = self.get_scope_filter("servers")
+        results = []
+        stopping = []
+        for name in names:
+            user_name, _, server_name = name.partition("/")
+            user = self.find_user(user_name)
+            orm_spawner = user and user.orm_spawners.get(server_name)
+            if orm_spawner is None or not has_access(orm_spawner, "server"):
+                # same answer for missing servers and missing permissions
+                results.append({"user": user_name, "server": server_name,
+                                "status": "not_found"})
+                continue
+
+            spawner = user.spawners[server_name]
+            if spawner.pending or not spawner.active:
+                status = spawner.pending or "not_running"
+                results.append({"user": user_name, "server": server_name,
+                                "status": status})
+            elif not isinstance(spawner, FirecRESTSpawnerBase):
+                result = {"user": user_name, "server": server_name,
+                          "status": "no_job"}
+                results.append(result)
+                stopping.append((user, spawner, result))
+            else:
+                stopping.append((user, spawner, None))
+
+        # ``cancel_jobs`` returns the results in the order of the spawners
+        cancelled = await FirecRESTSpawnerBase.cancel_jobs(
+            spawner for _, spawner, result in stopping if result is None
+        )
+        results.extend(cancelled)
+        cancelled = iter(cancelled)
+        stopping = [(user, spawner, result or next(cancelled))
+                    for user, spawner, result in stopping]
+        # the servers whose job may still be running are left as they are
+        stopping = [(user, spawner, result)
+                    for user, spawner, result in stopping
+                    if result["status"] != "failed"]
+
+        stopped = await asyncio.gather(*(
+            self.stop_single_user(user, spawner.name)
+            for user, spawner, _ in stopping
+        ), return_exceptions=True)
+        for (user, spawner, result), error in zip(stopping, stopped):
+            if isinstance(error, Exception):
+                self.log.warning(f"Failed stopping {spawner._log_name}: "
+                                 f"{error}")
+                result.update(status="stop_failed", error=str(error))
+
+        summary = {}
+        for result in results:
+            summary[result["status"]] = summary.get(result["status"], 0) + 1
+
+        self.finish(json.dumps({"summary": summary, "servers": results}))
+
+
 default_handlers.append((r"/api/firecrestspawner", FireCRESTSpawnerAPIHandler))
+default_handlers.append(
+    (r"/api/firecrestspawner/cancel", FireCRESTSpawnerCancelAPIHandler)
+)
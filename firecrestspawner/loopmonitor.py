@@ -0,0 +1,197 @@
+"""
+Monitor of the lag of the hub's event loop
+
+A coroutine measures how late it wakes up from a sleep of ``interval``
+seconds, which is the time other callbacks kept the event loop busy.
+A watchdog thread checks that the loop keeps running and, if it doesn't for
+more than ``threshold`` seconds, captures the stack of the loop's thread to
+find the spawner method and the user that are blocking it.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from jupyterhub.spawner import Spawner
+from firecrestspawner.metrics import (EVENT_LOOP_LAG_QUANTILE_SECONDS,
+                                      EVENT_LOOP_LAG_SECONDS,
+                                      EVENT_LOOP_STALLS)
+
+
+@dataclass(slots=True)
+class Stall:
+    """A period during which the event loop was blocked"""
+
+    duration: float
+    method: str = ""
+    user: str = ""
+    location: str = ""
+
+
+class BlockingCallError(AssertionError):
+    """Raised in test mode when a spawner blocks the event loop"""
+
+
+def find_blocking_call(frame) -> Stall:
+    """Returns the spawner method and the user of the innermost spawner
+    frame of a stack, and the location of the innermost frame"""
+    stall = Stall(
+        duration=0,
+        location=(f"{frame.f_code.co_filename}:{frame.f_lineno} "
+                  f"in {frame.f_code.co_name}")
+    )
+    while frame is not None:
+        spawner = frame.f_locals.get("self")
+        if isinstance(spawner, Spawner):
+            stall.method = f"{type(spawner).__name__}.{frame.f_code.co_name}"
+            user = getattr(spawner, "user", None)
+            stall.user = getattr(user, "name", "")
+            break
+
+        frame = frame.f_back
+
+    return stall
+
+
+class EventLoopMonitor:
+    """Monitor of the lag of the event loop
+
+    :param interval: seconds between two measurements of the lag
+    :param threshold: lag in seconds above which the loop is considered
+                      blocked and the call responsible for it is reported
+    :param log: logger where the stalls are reported
+    :param window: number of measurements used for the lag quantiles
+    :param max_stalls: number of recent stalls kept in ``stalls``
+    """
+
+    _monitor = None
+
+    def __init__(self, interval: float = 0.5, threshold: float = 0.1,
+                 log=None, window: int = 1000, max_stalls: int = 100):
+        self.interval = interval
+        self.threshold = threshold
+        self.log = log
+        self.lags = deque(maxlen=window)
+        self.stalls = deque(maxlen=max_stalls)
+        self._heartbeat = None
+        self._suspect = None
+        self._loop_thread = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def ensure_started(cls, **kwargs) -> "EventLoopMonitor":
+        """Start the monitor shared by the whole hub if it's not running"""
+        monitor = cls._monitor
+        if monitor is None or not monitor.running:
+            monitor = cls._monitor = cls(**kwargs)
+            monitor.start()
+
+        return monitor
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """Start monitoring the running event loop"""
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self._measure())
+        self._watchdog = threading.Thread(target=self._watch,
+                                          name="event-loop-watchdog",
+                                          daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def quantile(self, q: float) -> float:
+        """Returns the ``q`` quantile of the recent lags"""
+        if not self.lags:
+            return 0.0
+
+        lags = sorted(self.lags)
+        return lags[min(int(q * len(lags)), len(lags) - 1)]
+
+    async def _measure(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(loop.time() - before - self.interval, 0))
+
+    def record(self, lag: float) -> None:
+        """Record a measurement of the lag"""
+        self._heartbeat = time.monotonic()
+        self.lags.append(lag)
+        EVENT_LOOP_LAG_SECONDS.observe(lag)
+        for q in (0.5, 0.9, 0.99):
+            EVENT_LOOP_LAG_QUANTILE_SECONDS.labels(quantile=str(q)).set(
+                self.quantile(q)
+            )
+
+        suspect, self._suspect = self._suspect, None
+        if lag <= self.threshold:
+            return
+
+        stall = suspect or Stall(duration=0)
+        stall.duration = lag
+        self.stalls.append(stall)
+        EVENT_LOOP_STALLS.labels(method=stall.method or "unknown").inc()
+        if self.log is not None:
+            self.log.warning(
+                f"Event loop blocked for {lag:.3f}s by "
+                f"{stall.method or 'unknown method'} "
+                f"(user: {stall.user or 'unknown'}) at {stall.location}"
+            )
+
+    def _watch(self) -> None:
+        check_interval = max(self.threshold / 4, 0.005)
+        while not self._stopped.wait(check_interval):
+            blocked = time.monotonic() - self._heartbeat
+            if blocked <= self.interval + self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None or self._suspect is not None:
+                continue
+
+            # keep the first frame where the stall is seen, later ones
+            # may belong to the callbacks that ran after it
+            self._suspect = find_blocking_call(frame)
+
+
+@asynccontextmanager
+async def fail_on_blocking(limit: float, interval: float = 0.01):
+    """Test mode of the monitor
+
+    Raise ``BlockingCallError`` when exiting if a spawner method blocked
+    the event loop for longer than ``limit`` seconds within the context.
+    """
+    monitor = EventLoopMonitor(interval=interval, threshold=limit)
+    monitor.start()
+    try:
+        # let the monitor start measuring
+        await asyncio.sleep(0)
+        yield monitor
+        # give the monitor a chance to measure the last stall
+        await asyncio.sleep(interval * 2)
+    finally:
+        monitor.stop()
+
+    stalls = [stall for stall in monitor.stalls if stall.method]
+    if stalls:
+        raise BlockingCallError(
+            "Spawner blocked the event loop: " + "; ".join(
+                f"{stall.method} for {stall.duration:.3f}s "
+                f"at {stall.location}" for stall in stalls
+            )
+        )
@@ -0,0 +1,137 @@
+"""
+Prometheus metrics of the FirecREST spawner
+
+The metrics are registered in the default registry of ``prometheus_client``,
+which is the one JupyterHub exports in ``/hub/metrics``. Following
+JupyterHub's conventions, their names are ``<noun>_<verb>_<type_suffix>``
+with the ``firecrestspawner_`` prefix.
+"""
+
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+
+
+metrics_prefix = "firecrestspawner"
+
+request_duration_buckets = [
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")
+]
+
+queue_wait_buckets = [
+    1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, float("inf")
+]
+
+FIRECREST_REQUEST_DURATION_SECONDS = Histogram(
+    f"{metrics_prefix}_firecrest_request_duration_seconds",
+    "Time taken by the requests of the spawner to FireCREST",
+    ["operation", "host", "outcome"],
+    buckets=request_duration_buckets,
+)
+
+TOKEN_REFRESH_DURATION_SECONDS = Histogram(
+    f"{metrics_prefix}_token_refresh_duration_seconds",
+    "Time taken to refresh the access tokens of the users",
+    ["outcome"],
+    buckets=request_duration_buckets,
+)
+
+POLL_RETRIES = Counter(
+    f"{metrics_prefix}_poll_retries",
+    "Number of requests for the state of a job that were retried",
+    ["host"],
+)
+
+SUBMISSION_FAILURES = Counter(
+    f"{metrics_prefix}_submission_failures",
+    "Number of jobs whose submission failed",
+    ["host", "reason"],
+)
+
+JOBS = Gauge(
+    f"{metrics_prefix}_jobs",
+    "Number of notebook jobs by state",
+    ["host", "state"],
+)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    f"{metrics_prefix}_queue_wait_seconds",
+    "Time the notebook jobs spent waiting in the queue",
+    ["host"],
+    buckets=queue_wait_buckets,
+)
+
+WARM_POOL_ACQUISITIONS = Counter(
+    f"{metrics_prefix}_warm_pool_acquisitions",
+    "Number of spawns that looked for an allocation of the warm pool, "
+    "by outcome (hit or miss)",
+    ["host", "outcome"],
+)
+
+WARM_POOL_JOBS = Gauge(
+    f"{metrics_prefix}_warm_pool_jobs",
+    "Number of allocations waiting in the warm pools",
+    ["host"],
+)
+
+STOP_FAILURES = Counter(
+    f"{metrics_prefix}_stop_failures",
+    "Number of cancelled jobs that were still running after all the "
+    "cancellation attempts",
+    ["host"],
+)
+
+CIRCUIT_BREAKER_STATE = Gauge(
+    f"{metrics_prefix}_circuit_breaker_state",
+    "State of the circuit breaker of each service: 1 for its current state "
+    "(closed, open or half-open) and 0 for the others",
+    ["service", "state"],
+)
+
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    f"{metrics_prefix}_event_loop_lag_seconds",
+    "Delay of the callbacks of the hub's event loop",
+    buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+             float("inf")],
+)
+
+EVENT_LOOP_LAG_QUANTILE_SECONDS = Gauge(
+    f"{metrics_prefix}_event_loop_lag_quantile_seconds",
+    "Quantiles of the recent delays of the callbacks of the hub's event loop",
+    ["quantile"],
+)
+
+EVENT_LOOP_STALLS = Counter(
+    f"{metrics_prefix}_event_loop_stalls",
+    "Number of times the event loop was blocked longer than the threshold, "
+    "by the spawner method running at the time",
+    ["method"],
+)
+
+
+@contextmanager
+def observe_request(operation: str, host: str):
+    """Observe the duration and the outcome of a request to FireCREST"""
+    start = time.perf_counter()
+    outcome = "failure"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        FIRECREST_REQUEST_DURATION_SECONDS.labels(
+            operation=operation, host=host, outcome=outcome
+        ).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def observe_token_refresh():
+    """Observe the duration and the outcome of an access token refresh"""
+    start = time.perf_counter()
+    outcome = "failure"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        TOKEN_REFRESH_DURATION_SECONDS.labels(outcome=outcome).observe(
+            time.perf_counter() - start
+        )
@@ -1,24 +1,109 @@
+import ipaddress
+import json
 import os
+import socket
 import sys
+import threading
+import time
 from runpy import run_path
 from shutil import which
 from urllib.parse import urlparse
 
-import requests
-from jupyterhub.services.auth import HubAuth
-from jupyterhub.utils import url_path_join
 
+def get_node_ip(hostname):
+    """Returns the IP of the node, like ``hostname -i``
 
-def main(argv=None):
+    Loopback and link-local addresses (e.g. ``127.0.1.1`` in ``/etc/hosts``)
+    are skipped and IPv4 addresses are preferred over IPv6 ones, like
+    ``parse_node_ip`` does in the hub. An empty string is returned if no
+    address is found.
+    """
+    try:
+        addresses = socket.getaddrinfo(hostname, None)
+    except OSError:
+        return ""
+
+    ipv6 = ""
+    for *_, sockaddr in addresses:
+        try:
+            address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        except ValueError:
+            continue
+
+        if address.is_loopback or address.is_link_local:
+            continue
+
+        if address.version == 4:
+            return str(address)
+
+        ipv6 = ipv6 or str(address)
+
+    return ipv6
+
+
+def get_ssl_context():
+    """Returns the SSL context for the hub's internal SSL, if it's enabled"""
+    certfile = os.environ.get("JUPYTERHUB_SSL_CERTFILE")
+    if not certfile:
+        return None
+
+    import ssl
+
+    context = ssl.create_default_context(
+        cafile=os.environ.get("JUPYTERHUB_SSL_CLIENT_CA")
+    )
+    context.load_cert_chain(certfile, os.environ.get("JUPYTERHUB_SSL_KEYFILE"))
+    return context
+
+
+def report_to_hub(port, retries=5, delay=1, max_delay=16, timeout=10):
+    """Report the port, the node and the job of the server to the hub
+
+    The request is retried with exponential backoff if it fails.
+    Returns whether the hub received it.
+    """
+    # imported here to keep the server's startup fast
+    from urllib.request import Request, urlopen
+
+    hostname = socket.gethostname()
+    api_url = os.environ["JUPYTERHUB_API_URL"].rstrip("/")
+    request = Request(
+        f"{api_url}/firecrestspawner",
+        data=json.dumps({
+            "port": port,
+            "node_ip": get_node_ip(hostname),
+            "node_hostname": hostname,
+            "job_id": os.environ.get("SLURM_JOB_ID", ""),
+        }).encode(),
+        headers={
+            "Authorization": f"token {os.environ['JUPYTERHUB_API_TOKEN']}",
+            "Content-Type": "application/json",
+        },
+        method="POST",
+    )
+    context = get_ssl_context()
+    for attempt in range(retries + 1):
+        try:
+            with urlopen(request, timeout=timeout, context=context):
+                return True
+        except Exception as e:
+            print(f"firecrestspawner-singleuser: failed reporting to the hub "
+                  f"(attempt {attempt + 1}/{retries + 1}): {e}",
+                  file=sys.stderr)
+
+        if attempt < retries:
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    return False
+
+
+def main():
     url = urlparse(os.environ["JUPYTERHUB_SERVICE_URL"])
     port = url.port
-    hub_auth = HubAuth()
-    requests.post(
-        url=url_path_join(hub_auth.api_url, "firecrestspawner"),
-        headers={"Authorization": f"token {hub_auth.api_token}"},
-        json={"port": port},
-        timeout=30
-    )
+    # the hub is notified while the server starts
+    threading.Thread(target=report_to_hub, args=(port,),
+                     name="firecrestspawner-callback", daemon=True).start()
     cmd_path = which(sys.argv[1])
     sys.argv = sys.argv[1:] + ["--port={}".format(port)]
     run_path(cmd_path, run_name="__main__")
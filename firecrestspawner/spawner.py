@@ -7,29 +7,63 @@
 
 import asyncio
 import base64
-import hostlist
 import httpx
-import inspect
+import ipaddress
 import json
 import jupyterhub
+import logging
 import os
 import pwd
+import random
 import re
 import requests
+import shlex
 import sys
+import tempfile
 import time
+import weakref
 from async_generator import async_generator, yield_
-from enum import Enum
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from enum import Enum, StrEnum
+from functools import lru_cache
+from itertools import islice
+from firecrest.FirecrestException import FirecrestException
 from firecrest.FirecrestException import PollingIterException
 from firecrest import ClientCredentialsAuth
 from firecrest.FirecrestException import UnexpectedStatusException
+from firecrest.utilities import parse_retry_after
 from firecrest.v2._async.Client import AsyncFirecrest as Firecrest
-from jinja2 import Template
+from firecrestspawner import api  # noqa: F401 (registers the API handler)
+from firecrestspawner.loopmonitor import EventLoopMonitor
+from firecrestspawner.metrics import (CIRCUIT_BREAKER_STATE, JOBS,
+                                      POLL_RETRIES, QUEUE_WAIT_SECONDS,
+                                      STOP_FAILURES, SUBMISSION_FAILURES,
+                                      WARM_POOL_ACQUISITIONS, WARM_POOL_JOBS,
+                                      observe_request, observe_token_refresh)
+from jinja2 import Template, TemplateSyntaxError
 from jupyterhub.spawner import Spawner
 from time import sleep
 from tornado.web import HTTPError
-from traitlets import Any, Bool, Integer, Unicode, Float, default
-from typing import AsyncGenerator, Optional
+from traitlets import (Any, Bool, Dict, Enum as EnumTrait, Integer, Unicode,
+                       Float, TraitError, default, observe, validate)
+from typing import AsyncGenerator, Iterator, Optional
+
+
+def is_jinja2_template(template: str) -> bool:
+    """Return boolean indicating if a template string uses jinja2 syntax"""
+    return "{{" in template or "{%" in template
+
+
+@lru_cache(maxsize=32)
+def compile_template(template: str) -> Template:
+    """Compile a jinja2 template.
+
+    Compiled templates are cached, so templates that don't change at
+    runtime, like the batch script, are compiled only once.
+    """
+    return Template(template)
 
 
 def format_template(template, *args, **kwargs):
@@ -41,8 +75,8 @@ def format_template(template, *args, **kwargs):
     """
     if isinstance(template, Template):
         return template.render(*args, **kwargs)
-    elif "{{" in template or "{%" in template:
-        return Template(template).render(*args, **kwargs)
+    elif is_jinja2_template(template):
+        return compile_template(template).render(*args, **kwargs)
     return template.format(*args, **kwargs)
 
 
@@ -66,6 +100,516 @@ class JobStatus(Enum):
     UNKNOWN = 3
 
 
+def _split_hostlist(nodelist: str) -> Iterator[str]:
+    """Yield the comma-separated items of a hostlist, ignoring the commas
+    inside brackets"""
+    depth = 0
+    start = 0
+    for i, char in enumerate(nodelist):
+        if char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            yield nodelist[start:i]
+            start = i + 1
+
+    yield nodelist[start:]
+
+
+def _iter_range(ranges: str) -> Iterator[str]:
+    """Yield the values of the content of a bracket, like ``001-003,7``"""
+    for rng in ranges.split(","):
+        low, sep, high = rng.partition("-")
+        if not low.isdigit() or (sep and not high.isdigit()):
+            raise ValueError(f"Bad range in hostlist: [{ranges}]")
+
+        if not sep:
+            yield low
+            continue
+
+        start, stop = int(low), int(high)
+        if start > stop:
+            raise ValueError(f"Bad range in hostlist: [{ranges}]")
+
+        width = len(low)
+        for i in range(start, stop + 1):
+            yield f"{i:0{width}d}"
+
+
+def _iter_hostlist_item(item: str) -> Iterator[str]:
+    """Yield the hosts of an item of a hostlist, like ``x[1-2]y[3-4]``"""
+    bracket = item.find("[")
+    if bracket == -1:
+        yield item
+        return
+
+    end = item.find("]", bracket)
+    if end == -1:
+        raise ValueError(f"Unbalanced brackets in hostlist: {item}")
+
+    prefix = item[:bracket]
+    rest = item[end + 1:]
+    for value in _iter_range(item[bracket + 1:end]):
+        for suffix in _iter_hostlist_item(rest):
+            yield f"{prefix}{value}{suffix}"
+
+
+def iter_hostlist(nodelist: str) -> Iterator[str]:
+    """Yield the hosts of a hostlist in Slurm's format (e.g.
+    ``nid[001-003,007],login01``) without expanding the whole list.
+
+    The hosts are yielded in the same order as
+    ``hostlist.expand_hostlist``, without duplicates.
+    """
+    seen = set()
+    for item in _split_hostlist(nodelist):
+        for host in _iter_hostlist_item(item.strip()):
+            if host and host not in seen:
+                seen.add(host)
+                yield host
+
+
+def first_hosts(nodelist: str, n: int = 1) -> list[str]:
+    """Returns the first ``n`` hosts of a hostlist in Slurm's format"""
+    if "[" not in nodelist and "," not in nodelist:
+        # single node
+        return [nodelist] if nodelist else []
+
+    return list(islice(iter_hostlist(nodelist), n))
+
+
+def parse_node_ip(output: str) -> str:
+    """Returns the IP address of the node from the output of `hostname -i`
+
+    The command may print several addresses. Loopback and link-local
+    addresses are skipped and IPv4 addresses are preferred over IPv6
+    ones. An empty string is returned if no address is found.
+    """
+    ipv6 = ""
+    for token in output.split():
+        try:
+            address = ipaddress.ip_address(token.split("%")[0])
+        except ValueError:
+            continue
+
+        if address.is_loopback or address.is_link_local:
+            continue
+
+        if address.version == 4:
+            return str(address)
+
+        ipv6 = ipv6 or str(address)
+
+    return ipv6
+
+
+class SlurmJobState(StrEnum):
+    """States of a job in Slurm, as reported by FireCREST"""
+    PENDING = "PENDING"
+    CONFIGURING = "CONFIGURING"
+    RUNNING = "RUNNING"
+    COMPLETING = "COMPLETING"
+    SUSPENDED = "SUSPENDED"
+    REQUEUED = "REQUEUED"
+    RESIZING = "RESIZING"
+    COMPLETED = "COMPLETED"
+    CANCELLED = "CANCELLED"
+    FAILED = "FAILED"
+    TIMEOUT = "TIMEOUT"
+    NODE_FAIL = "NODE_FAIL"
+    PREEMPTED = "PREEMPTED"
+    BOOT_FAIL = "BOOT_FAIL"
+    DEADLINE = "DEADLINE"
+    OUT_OF_MEMORY = "OUT_OF_MEMORY"
+
+
+#: Slurm states of the jobs that are no longer pending or running
+FINISHED_JOB_STATES = frozenset({
+    SlurmJobState.BOOT_FAIL, SlurmJobState.CANCELLED, SlurmJobState.COMPLETED,
+    SlurmJobState.DEADLINE, SlurmJobState.FAILED, SlurmJobState.NODE_FAIL,
+    SlurmJobState.OUT_OF_MEMORY, SlurmJobState.PREEMPTED,
+    SlurmJobState.TIMEOUT,
+})
+
+# faster than ``SlurmJobState(state)`` for the jobs of every poll
+_SLURM_JOB_STATES = {state.value: state for state in SlurmJobState}
+
+
+@dataclass(slots=True)
+class JobState:
+    """State of a job, built once from the job information returned by
+    FirecREST
+
+    :param job_id: ID of the job
+    :param state: state of the job in the scheduler, a ``SlurmJobState``
+                  unless the scheduler reports an unknown state or a list
+                  of states (e.g. ``"RUNNING,COMPLETING"``)
+    :param nodes: nodes allocated to the job in the scheduler's hostlist
+                  format
+    :param reason: reason for the state given by the scheduler
+    :param start_time: start time of the job (or expected start time if
+                       the job is pending) as a Unix timestamp
+    :param end_time: end time of the job as a Unix timestamp
+    """
+    job_id: str
+    state: SlurmJobState | str
+    nodes: str = ""
+    reason: str = ""
+    start_time: Optional[int] = None
+    end_time: Optional[int] = None
+
+    @classmethod
+    def from_job_info(cls, job_info: dict):
+        """Build the job state from an item of the result of the client's
+        ``job_info``"""
+        status = job_info.get("status")
+        if status is not None:
+            state = status.get("state", "")
+            reason = status.get("stateReason")
+        else:
+            # older versions of the API
+            status = job_info.get("state") or {}
+            state = status.get("current", "")
+            reason = status.get("reason")
+
+        if isinstance(state, list):
+            state = ",".join(state)
+
+        # states unknown to this version or lists of states are kept
+        # as they are reported
+        state = _SLURM_JOB_STATES.get(state, state)
+
+        job_time = job_info.get("time") or {}
+        return cls(
+            job_id=str(job_info.get("jobId", "")),
+            state=state,
+            nodes=job_info.get("nodes") or "",
+            reason=reason if reason and reason != "None" else "",
+            start_time=job_time.get("start"),
+            end_time=job_time.get("end"),
+        )
+
+    @property
+    def host(self) -> str:
+        """First node allocated to the job"""
+        # when PENDING nodelist is []
+        nodelist = first_hosts(self.nodes)
+        return nodelist[0] if len(nodelist) > 0 else ""
+
+    @property
+    def is_finished(self) -> bool:
+        """Whether the job has left the scheduler's queue"""
+        return not FINISHED_JOB_STATES.isdisjoint(self.state.split(","))
+
+    @property
+    def job_status(self) -> str:
+        """The state in the format of ``job_status``"""
+        # `job_status` must keep the format used in the original
+        # batchspawner since it will be later parsed with
+        # regular expressions
+        return f"{self.state} {self.host}"
+
+
+@lru_cache(maxsize=64)
+def compile_regex(pattern: str) -> re.Pattern:
+    """Compile a regular expression, caching the result"""
+    return re.compile(pattern)
+
+
+class CircuitOpenError(HTTPError):
+    """Raised instead of calling a service whose circuit breaker is open"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(
+            503,
+            f"{name} is not available at the moment. "
+            f"Please try again in {max(int(retry_after), 1)} seconds."
+        )
+        self.name = name
+        self.retry_after = retry_after
+        self.html_message = (
+            "The service used to manage the jobs is not available at the "
+            "moment. Please try again in a few minutes."
+        )
+
+
+class CircuitBreaker:
+    """Circuit breaker for the calls to a service
+
+    :param name: name of the service, typically its URL
+    :param failure_threshold: number of consecutive failures after which
+                              the circuit opens
+    :param reset_timeout: time in seconds during which the calls fail fast
+                          before a probe is let through
+    :param latency_threshold: calls slower than this number of seconds
+                              count as failures
+
+    A call fails if it raises a transport error, returns (or raises) a
+    server error or takes longer than ``latency_threshold``. While the
+    circuit is open, calls raise ``CircuitOpenError`` without reaching the
+    service. Once ``reset_timeout`` has passed, the circuit is half-open:
+    a single call is let through and closes the circuit if it succeeds
+    or opens it again otherwise.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    _breakers = {}
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        latency_threshold: float = 10,
+        log=None,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_threshold = latency_threshold
+        self.log = log
+        self.state = self.CLOSED
+        self._observe_state()
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @classmethod
+    def get_breaker(cls, name: str, **kwargs) -> "CircuitBreaker":
+        """Returns the circuit breaker of a service, creating it if
+        needed"""
+        breaker = cls._breakers.get(name)
+        if breaker is None:
+            breaker = cls._breakers[name] = cls(name, **kwargs)
+        else:
+            for key, value in kwargs.items():
+                setattr(breaker, key, value)
+
+        return breaker
+
+    @classmethod
+    def states(cls) -> dict:
+        """Returns the state of the circuit breaker of every service"""
+        return {name: breaker.state
+                for name, breaker in cls._breakers.items()}
+
+    @classmethod
+    def clear(cls) -> None:
+        """Drop all the circuit breakers"""
+        cls._breakers.clear()
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state and self.log is not None:
+            self.log.warning(f"Circuit breaker for {self.name} is {state}")
+        self.state = state
+        self._observe_state()
+
+    def _observe_state(self) -> None:
+        for state in (self.CLOSED, self.OPEN, self.HALF_OPEN):
+            CIRCUIT_BREAKER_STATE.labels(
+                service=self.name, state=state
+            ).set(int(state == self.state))
+
+    def before_call(self) -> None:
+        """Raise ``CircuitOpenError`` if the call must not be done"""
+        if self.state == self.CLOSED:
+            return
+
+        elapsed = time.monotonic() - self.opened_at
+        if self.state == self.OPEN and elapsed >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return
+
+        raise CircuitOpenError(self.name,
+                               max(self.reset_timeout - elapsed, 0))
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probing = False
+        self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if (self.state == self.HALF_OPEN or
+                self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    @staticmethod
+    def is_failure(result) -> bool:
+        """Return boolean indicating if the result or exception of a call
+        means that the service is failing"""
+        if isinstance(result, (httpx.TransportError, asyncio.TimeoutError,
+                               requests.ConnectionError, requests.Timeout)):
+            return True
+
+        if isinstance(result, FirecrestException) and result.responses:
+            result = result.responses[-1]
+
+        status_code = getattr(result, "status_code", None)
+        return status_code is not None and status_code >= 500
+
+    async def call(self, func, *args, **kwargs):
+        """Await ``func(*args, **kwargs)`` through the circuit breaker"""
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            if self.is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except BaseException:
+            # e.g. cancelled, the probe must be done again
+            self._probing = False
+            raise
+
+        if (self.is_failure(result) or
+                time.monotonic() - start > self.latency_threshold):
+            self.record_failure()
+        else:
+            self.record_success()
+
+        return result
+
+
+class RateLimiter:
+    """Rate and concurrency limiter for the requests to a FireCREST
+    service group
+
+    :param rate: average number of requests per second. If it's not
+                 positive, the rate isn't limited
+    :param burst: maximum number of requests that can be done at once
+                  after a period without requests
+    :param max_in_flight: maximum number of concurrent requests
+
+    The rate is limited with a token bucket. Low priority requests (the
+    polls of the jobs) wait while there are high priority requests
+    waiting for a token. ``pause`` stops all the requests for a while,
+    e.g. when FireCREST answers with ``Retry-After``.
+    """
+
+    _limiters = {}
+
+    def __init__(self, rate: float = 5, burst: int = 10,
+                 max_in_flight: int = 20):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._high_priority_waiting = 0
+
+    @classmethod
+    def get_limiter(cls, firecrest_url: str, group: str,
+                    **kwargs) -> "RateLimiter":
+        """Returns the limiter shared by all the clients for a service
+        group of FireCREST, creating it if needed
+
+        Limiters are indexed by their configuration as well, so a new one
+        is used if the limits change.
+        """
+        key = (firecrest_url, group, tuple(sorted(kwargs.items())))
+        limiter = cls._limiters.get(key)
+        if limiter is None:
+            limiter = cls._limiters[key] = cls(**kwargs)
+
+        return limiter
+
+    @classmethod
+    def clear(cls) -> None:
+        """Drop all the limiters"""
+        cls._limiters.clear()
+
+    def pause(self, seconds: float) -> None:
+        """Hold all the requests for ``seconds``"""
+        self.paused_until = max(self.paused_until,
+                                time.monotonic() + seconds)
+
+    def _take_token(self, now: float) -> float:
+        """Take a token if available and return 0, or return the time to
+        wait for one"""
+        if self.rate <= 0:
+            return 0
+
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self, high_priority: bool = True) -> None:
+        """Wait for a token and for a free request slot"""
+        if high_priority:
+            self._high_priority_waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if not high_priority and self._high_priority_waiting:
+                        wait = 1 / self.rate if self.rate > 0 else 0.01
+                    else:
+                        wait = self._take_token(now)
+                        if wait == 0:
+                            break
+
+                await asyncio.sleep(wait)
+        finally:
+            if high_priority:
+                self._high_priority_waiting -= 1
+
+        await self._semaphore.acquire()
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def limit(self, high_priority: bool = True):
+        """Context manager holding a request slot"""
+        await self.acquire(high_priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def jwt_expiration(token: str) -> Optional[float]:
+    """Returns the ``exp`` claim of a JWT as a Unix timestamp, or ``None``
+    if the token is not a JWT or has no expiration.
+
+    The signature is not verified, the result is only meant to tell
+    whether a token issued to the hub has expired.
+    """
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(
+            payload + "=" * (-len(payload) % 4)
+        ))
+        exp = claims.get("exp")
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+
+    return float(exp) if isinstance(exp, (int, float)) and exp > 0 else None
+
+
 class AuthorizationCodeFlowAuth:
     """
     Authorization Code Flow class
@@ -74,41 +618,157 @@ class AuthorizationCodeFlowAuth:
     :param client_secret: secret associated to the client
     :param refresh_token: refresh token for the SSO session
     :param token_url: URL of the token request in the authorization server
+    :param min_token_validity: seconds before the expiration of the access
+                               token at which it is refreshed
 
     This is used with PyFirecREST clients based on Keycloak's Authorization
     Code Flow method. It's simlar PyFirecREST's ``ClientCredentialsAuth`` class
     which is used with clients based on the Keycloak's Client Credentials
     method.
+
+    The access token is reused until ``min_token_validity`` seconds before it
+    expires. Objects obtained with ``get_auth`` are shared by all the spawners
+    of a user, so the token is refreshed once for all of them.
     """
 
+    # Authorization objects shared by all the spawners of a user,
+    # indexed by (username, token_url)
+    _cache = {}
+
     def __init__(
         self,
         client_id: str,
         client_secret: str,
         refresh_token: str,
         token_url: str,
+        min_token_validity: float = 30,
     ):
         self.client_id = client_id
         self.client_secret = client_secret
         self.token_url = token_url
         self.refresh_token = refresh_token
+        self.min_token_validity = min_token_validity
+        self.access_token = None
+        self.token_expiration_ts = None
+        #: Expiration of the refresh token given by the last token
+        #: response, if the authorization server reports it
+        self.refresh_token_expiration_ts = None
+        #: Coroutine function called with the new refresh token when
+        #: the authorization server rotates it
+        self.on_refresh_token = None
+        # refresh tokens replaced by rotation, which may still be found
+        # in an ``auth_state`` that hasn't been updated yet
+        self._replaced_refresh_tokens = deque(maxlen=8)
+        self._refresh = None
+        #: ``httpx.AsyncClient`` used to refresh the token. If ``None``,
+        #: a new one is created for each request
+        self.http_client = None
+        #: ``CircuitBreaker`` of the authorization server
+        self.circuit_breaker = None
+
+    @classmethod
+    def get_auth(
+        cls,
+        username: str,
+        client_id: str,
+        client_secret: str,
+        refresh_token: str,
+        token_url: str,
+        min_token_validity: float = 30,
+    ):
+        """Returns the authorization object shared by the spawners
+        of a user"""
+        key = (username, token_url)
+        auth = cls._cache.get(key)
+        if auth is None:
+            auth = cls._cache[key] = cls(
+                client_id,
+                client_secret,
+                refresh_token,
+                token_url,
+                min_token_validity,
+            )
+        elif (refresh_token != auth.refresh_token and
+              refresh_token not in auth._replaced_refresh_tokens):
+            # the user has logged in again
+            auth.refresh_token = refresh_token
+            auth.access_token = None
+            auth.refresh_token_expiration_ts = None
+
+        auth.min_token_validity = min_token_validity
+        return auth
+
+    @classmethod
+    def clear(cls) -> None:
+        """Drop all the shared authorization objects"""
+        cls._cache.clear()
+
+    def is_token_valid(self) -> bool:
+        """Return boolean indicating if the cached access token can be used
+        for at least ``min_token_validity`` seconds"""
+        return bool(
+            self.access_token and
+            self.token_expiration_ts and
+            time.time() <= self.token_expiration_ts - self.min_token_validity
+        )
 
-    def get_access_token(self) -> Optional[str]:
-        """Returns an access token to be used for accessing resources.
+    def has_valid_credentials(self) -> Optional[bool]:
+        """Return boolean indicating if the user's credentials are still
+        valid, without contacting the authorization server.
 
-        Given a refresh token, this function does a request to Keycloak
-        to refresh the access token. If the request is successful, the
-        access token is returned, otherwise the function returns ``None``.
+        The credentials are valid while the access token is, and afterwards
+        until the refresh token expires. Its expiration is taken from the
+        last token response or, if the token is a JWT, from its ``exp``
+        claim. ``None`` is returned if it's unknown.
         """
-        params = {
+        if self.is_token_valid():
+            return True
+
+        expiration = (self.refresh_token_expiration_ts or
+                      jwt_expiration(self.refresh_token))
+        if expiration is None:
+            return None
+
+        return time.time() < expiration
+
+    def _token_request_params(self) -> dict:
+        return {
             "grant_type": "refresh_token",
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "refresh_token": self.refresh_token,
         }
+
+    def _request_token(self) -> dict:
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        response = requests.post(self.token_url, data=params, headers=headers, timeout=30)
+        response = requests.post(self.token_url,
+                                 data=self._token_request_params(),
+                                 headers=headers,
+                                 timeout=30)
+        return self._check_token_response(response)
+
+    async def _async_request_token(self) -> dict:
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if self.http_client is not None:
+            response = await self.http_client.post(
+                self.token_url,
+                data=self._token_request_params(),
+                headers=headers,
+                timeout=30
+            )
+        else:
+            async with httpx.AsyncClient(timeout=30) as client:
+                response = await client.post(
+                    self.token_url,
+                    data=self._token_request_params(),
+                    headers=headers
+                )
 
+        return self._check_token_response(response)
+
+    def _check_token_response(self, response) -> dict:
+        """Returns the JSON body of a token response (either from
+        ``requests`` or ``httpx``) or raises an ``HTTPError``"""
         if response.status_code != 200:
             # if the refresh token is expired, Keycloak returns
             #
@@ -125,10 +785,896 @@ class AuthorizationCodeFlowAuth:
             )
             raise err
 
-        json_response = response.json()
-        self.refresh_token = json_response["refresh_token"]
+        return response.json()
+
+    def _update_tokens(self, json_response: dict) -> Optional[str]:
+        """Store the tokens of a token response.
+
+        Returns the new refresh token if it has been rotated."""
+        self.access_token = json_response["access_token"]
+        self.token_expiration_ts = time.time() + json_response.get("expires_in", 0)
+        # Keycloak reports 0 for the refresh tokens that don't expire
+        refresh_expires_in = json_response.get("refresh_expires_in")
+        self.refresh_token_expiration_ts = (
+            time.time() + refresh_expires_in if refresh_expires_in else None
+        )
+        refresh_token = json_response.get("refresh_token")
+        if refresh_token and refresh_token != self.refresh_token:
+            self._replaced_refresh_tokens.append(self.refresh_token)
+            self.refresh_token = refresh_token
+            return refresh_token
+
+        return None
+
+    def get_access_token(self) -> Optional[str]:
+        """Returns an access token to be used for accessing resources.
+
+        Given a refresh token, this function does a request to Keycloak
+        to refresh the access token. If the request is successful, the
+        access token is returned, otherwise the function returns ``None``.
+        The access token is reused while it's valid.
+        """
+        if self.is_token_valid():
+            return self.access_token
+
+        rotated = self._update_tokens(self._request_token())
+        if rotated and self.on_refresh_token:
+            try:
+                asyncio.ensure_future(self.on_refresh_token(rotated))
+            except RuntimeError:
+                # no event loop is running
+                pass
+
+        return self.access_token
+
+    async def async_get_access_token(self) -> Optional[str]:
+        """Asynchronous version of ``get_access_token``.
+
+        The request to the authorization server is done with
+        ``httpx.AsyncClient``, so it doesn't block the event loop.
+        Concurrent calls while the token is being refreshed wait for the same
+        request.
+        """
+        if self.is_token_valid():
+            return self.access_token
+
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.ensure_future(self._async_refresh())
+
+        await asyncio.shield(self._refresh)
+        return self.access_token
+
+    async def _async_refresh(self) -> None:
+        with observe_token_refresh():
+            if self.circuit_breaker is not None:
+                json_response = await self.circuit_breaker.call(
+                    self._async_request_token
+                )
+            else:
+                json_response = await self._async_request_token()
+
+        rotated = self._update_tokens(json_response)
+        if rotated and self.on_refresh_token:
+            await self.on_refresh_token(rotated)
+
+
+class AsyncClientCredentialsAuth(ClientCredentialsAuth):
+    """PyFirecREST's ``ClientCredentialsAuth`` with an asynchronous
+    ``async_get_access_token()``
+
+    ``ClientCredentialsAuth`` requests the token with ``requests``, which
+    blocks the event loop. Here the request is done in the default executor,
+    through ``circuit_breaker`` if it's set. Concurrent calls while the token
+    is being requested wait for the same request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        #: ``CircuitBreaker`` of the authorization server
+        self.circuit_breaker = None
+        self._refresh = None
+
+    def is_token_valid(self) -> bool:
+        """Return boolean indicating if the access token can be reused"""
+        return bool(
+            self._access_token and self._token_expiration_ts and
+            time.time() <= self._token_expiration_ts - self._min_token_validity
+        )
+
+    async def async_get_access_token(self) -> str:
+        """Asynchronous version of ``get_access_token``"""
+        if self.is_token_valid():
+            return self._access_token
 
-        return json_response["access_token"]
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.ensure_future(self._async_refresh())
+
+        return await asyncio.shield(self._refresh)
+
+    async def _request_token(self) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_access_token)
+
+    async def _async_refresh(self) -> str:
+        if self.circuit_breaker is not None:
+            return await self.circuit_breaker.call(self._request_token)
+
+        return await self._request_token()
+
+
+class AsyncAuthFirecrest(Firecrest):
+    """``AsyncFirecrest`` client that awaits the authorization object
+    before each request.
+
+    PyFirecREST calls ``get_access_token()`` synchronously when building the
+    headers of a request. If the authorization object provides
+    ``async_get_access_token()``, it's awaited first so that the token is
+    refreshed without blocking the event loop and the synchronous call just
+    returns the cached token.
+
+    If ``circuit_breaker`` is set, the requests go through it. If
+    ``rate_limiters`` is set, the requests to each service group wait for
+    its limiter. The ``429 Too Many Requests`` answers are retried by the
+    client instead of PyFirecREST: the limiter of the group is paused for
+    the time given by FireCREST, so that the other requests wait as well,
+    and the waits neither hold a request slot nor count in the latency
+    measured by the circuit breaker.
+    """
+
+    circuit_breaker = None
+    #: ``RateLimiter`` of each service group (``compute``, ``status``, ...)
+    rate_limiters = None
+    #: Number of retries of a request answered with ``429``. When it is
+    #: ``None``, the request is retried until it's accepted
+    rate_limit_retries = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the rate limit is handled by ``_request``
+        self.num_retries_rate_limit = 0
+
+    async def _authorize(self) -> None:
+        get_access_token = getattr(self._authorization,
+                                   "async_get_access_token", None)
+        if get_access_token is not None:
+            await get_access_token()
+
+    async def _send(self, request, *args, **kwargs) -> httpx.Response:
+        if self.circuit_breaker is None:
+            return await request(*args, **kwargs)
+
+        return await self.circuit_breaker.call(request, *args, **kwargs)
+
+    async def _request(self, method, request, *args,
+                       **kwargs) -> httpx.Response:
+        endpoint = kwargs.get("endpoint", args[0] if args else "")
+        limiter = None
+        if self.rate_limiters:
+            limiter = self.rate_limiters.get(endpoint.split("/")[1])
+
+        # the polls of the jobs give way to the requests of the users
+        high_priority = not (method == "GET" and
+                             endpoint.startswith("/compute/"))
+        retries = 0
+        while True:
+            if limiter is None:
+                resp = await self._send(request, *args, **kwargs)
+            else:
+                async with limiter.limit(high_priority):
+                    resp = await self._send(request, *args, **kwargs)
+
+            if resp.status_code != self.TOO_MANY_REQUESTS_CODE:
+                return resp
+
+            reset = parse_retry_after(
+                resp.headers.get("Retry-After",
+                                 resp.headers.get("RateLimit-Reset", 10)),
+                self.log
+            )
+            if limiter is not None:
+                # hold the other requests to the group as well
+                limiter.pause(reset)
+
+            if (self.rate_limit_retries is not None and
+                    retries >= self.rate_limit_retries):
+                return resp
+
+            self.log(
+                logging.INFO,
+                f"Rate limit is reached, will sleep for {reset} seconds "
+                "and try again"
+            )
+            if limiter is None:
+                await asyncio.sleep(reset)
+
+            # otherwise, the retry waits for the limiter
+            retries += 1
+
+    async def _get_request(self, *args, **kwargs) -> httpx.Response:
+        await self._authorize()
+        return await self._request("GET", super()._get_request,
+                                   *args, **kwargs)
+
+    async def _post_request(self, *args, **kwargs) -> httpx.Response:
+        await self._authorize()
+        return await self._request("POST", super()._post_request,
+                                   *args, **kwargs)
+
+    async def _put_request(self, *args, **kwargs) -> httpx.Response:
+        await self._authorize()
+        return await self._request("PUT", super()._put_request,
+                                   *args, **kwargs)
+
+    async def _delete_request(self, *args, **kwargs) -> httpx.Response:
+        await self._authorize()
+        return await self._request("DELETE", super()._delete_request,
+                                   *args, **kwargs)
+
+
+class FirecrestClientRegistry:
+    """Registry of long-lived firecrest clients shared by all spawners
+
+    Clients are indexed by ``(identity, firecrest_url)`` and all of them use
+    the same ``httpx.AsyncClient``, so connections to FirecREST (and to the
+    authorization server) are kept alive and reused instead of doing new
+    TCP and TLS handshakes for every client. Clients that haven't been used
+    for ``idle_timeout`` seconds are dropped.
+    """
+
+    # (identity, firecrest_url) -> [client, time of last use]
+    _clients = {}
+    _session = None
+    # the event loop the session is bound to
+    _loop = None
+    _last_eviction = 0.0
+
+    @classmethod
+    def get_session(
+        cls,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30,
+        http2: bool = False,
+    ) -> httpx.AsyncClient:
+        """Returns the HTTP connection pool shared by all clients"""
+        loop = asyncio.get_running_loop()
+        if cls._session is None or cls._session.is_closed or cls._loop is not loop:
+            # connections can't be used across event loops
+            cls._clients.clear()
+            cls._loop = loop
+            cls._session = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+                http2=http2,
+            )
+
+        return cls._session
+
+    @classmethod
+    def get_client(
+        cls,
+        identity,
+        firecrest_url: str,
+        authorization,
+        idle_timeout: float = 3600,
+        client_class=None,
+        **session_kwargs,
+    ):
+        """Returns the client of an identity, creating it if needed.
+
+        If ``authorization`` is ``None``, the authorization object of an
+        existing client is kept.
+        """
+        session = cls.get_session(**session_kwargs)
+        now = time.monotonic()
+        if now - cls._last_eviction > min(idle_timeout, 60):
+            cls.evict_idle(idle_timeout)
+
+        key = (identity, firecrest_url)
+        entry = cls._clients.get(key)
+        if entry is None:
+            client_class = client_class or AsyncAuthFirecrest
+            client = client_class(
+                firecrest_url=firecrest_url, authorization=authorization
+            )
+            # the session created by the client hasn't opened
+            # any connection yet, it can just be replaced
+            client._session = session
+            client.time_between_calls = {
+                "compute": 0,
+                "reservations": 0,
+                "status": 0,
+                "storage": 0,
+                "tasks": 0,
+                "utilities": 0,
+            }
+            client.timeout = 30
+            entry = cls._clients[key] = [client, now]
+        else:
+            if authorization is not None:
+                entry[0]._authorization = authorization
+            entry[1] = now
+
+        return entry[0]
+
+    @classmethod
+    def evict_idle(cls, idle_timeout: float) -> None:
+        """Drop the clients that haven't been used for ``idle_timeout``
+        seconds"""
+        now = time.monotonic()
+        cls._last_eviction = now
+        for key, (client, last_used) in list(cls._clients.items()):
+            if now - last_used > idle_timeout:
+                del cls._clients[key]
+
+    @classmethod
+    async def close(cls) -> None:
+        """Close the shared connection pool"""
+        cls._clients.clear()
+        if cls._session is not None and cls._loop is asyncio.get_running_loop():
+            await cls._session.aclose()
+
+        cls._session = None
+        cls._loop = None
+
+    @classmethod
+    def clear(cls) -> None:
+        """Drop all the clients without closing the connection pool"""
+        cls._clients.clear()
+        cls._session = None
+        cls._loop = None
+
+
+class JobStatusPoller:
+    """Shared poller for the status of the notebook jobs of a host
+
+    :param host: name of the system where the jobs run
+    :param client_factory: coroutine function returning a firecrest client
+                           able to list the jobs of all users (typically a
+                           service account client)
+    :param interval: maximum age in seconds of the jobs listing before a new
+                     one is requested
+
+    Instead of issuing one ``job_info`` request per spawner, the poller
+    requests the listing of the jobs of all users of a host once per
+    ``interval`` and serves every registered job from that snapshot.
+    Concurrent readers share the same in-flight request, so the number of
+    requests to FirecREST depends on the number of hosts rather than on the
+    number of users. After a failed listing, the spawners poll their jobs
+    individually for ``failure_backoff`` seconds.
+    """
+
+    # One poller per (firecrest_url, host) shared by all spawners
+    _pollers = {}
+
+    #: Seconds during which the listing isn't used after it fails
+    failure_backoff = 60
+
+    def __init__(self, host, client_factory, interval=5.0):
+        self.host = host
+        self.client_factory = client_factory
+        self.interval = interval
+        self.job_ids = set()
+        self.jobs = {}
+        self.updated = None
+        self.failed = None
+        self._listing = None
+
+    @classmethod
+    def get_poller(cls, firecrest_url, host, client_factory, interval=5.0):
+        """Returns the poller shared by all spawners for a given host"""
+        key = (firecrest_url, host)
+        poller = cls._pollers.get(key)
+        if poller is None:
+            poller = cls._pollers[key] = cls(host, client_factory, interval)
+        else:
+            poller.interval = interval
+
+        return poller
+
+    @classmethod
+    def clear(cls) -> None:
+        """Drop all the shared pollers"""
+        cls._pollers.clear()
+
+    def register(self, job_id) -> None:
+        """Add a job to the set of jobs tracked by the poller"""
+        if job_id:
+            self.job_ids.add(str(job_id))
+
+    def reconcile(self, job_id, log=None) -> None:
+        """Track a job restored from the hub's database
+
+        All the jobs restored when the hub starts are answered from the
+        same listing, which is requested in the background as soon as
+        possible. Like any job missing from the listing, a restored job
+        that isn't part of it is polled individually.
+        """
+        if not job_id:
+            return
+
+        self.register(job_id)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # the listing will be requested by the first poll
+            return
+
+        if self._listing is None or self._listing.done():
+            self._listing = asyncio.ensure_future(self._list_jobs())
+
+            def _done(task):
+                # nobody awaits the listing until the first poll
+                if task.cancelled() or task.exception() is None:
+                    return
+
+                if log is not None:
+                    log.warning(
+                        f"Listing the jobs of {self.host} to verify the "
+                        f"restored jobs failed: {task.exception()}"
+                    )
+
+            self._listing.add_done_callback(_done)
+
+    def unregister(self, job_id) -> None:
+        """Stop tracking a job"""
+        self.job_ids.discard(str(job_id))
+        self.jobs.pop(str(job_id), None)
+
+    def is_backing_off(self) -> bool:
+        """Return boolean indicating if the listing failed recently"""
+        return (self.failed is not None and
+                time.monotonic() - self.failed < self.failure_backoff)
+
+    def is_stale(self) -> bool:
+        """Return boolean indicating if the snapshot must be refreshed"""
+        return (self.updated is None or
+                time.monotonic() - self.updated > self.interval)
+
+    async def refresh(self) -> None:
+        """Refresh the snapshot with a single jobs listing request
+
+        If a listing is already in flight, wait for it instead of issuing
+        a new request.
+        """
+        if self._listing is None or self._listing.done():
+            self._listing = asyncio.ensure_future(self._list_jobs())
+
+        # ``shield`` prevents a cancelled reader (e.g. a spawner whose
+        # start times out) from cancelling the listing of the others
+        await asyncio.shield(self._listing)
+
+    async def _list_jobs(self) -> None:
+        try:
+            client = await self.client_factory()
+            with observe_request("job_info", self.host):
+                jobs = await client.job_info(self.host, allusers=True)
+        except Exception:
+            self.failed = time.monotonic()
+            raise
+
+        self.failed = None
+
+        # keep only the jobs of the spawners since the listing
+        # includes all the jobs in the system
+        self.jobs = {
+            str(job["jobId"]): job for job in jobs
+            if str(job["jobId"]) in self.job_ids
+        }
+        self.updated = time.monotonic()
+
+    async def job_info(self, job_id) -> list:
+        """Return the job information of a registered job
+
+        The result has the same format as the one of the client's
+        ``job_info``. An empty list is returned if the job is not part of
+        the snapshot.
+        """
+        self.register(job_id)
+        if self.is_stale():
+            await self.refresh()
+
+        job = self.jobs.get(str(job_id))
+        return [job] if job else []
+
+
+class UserInfoCache:
+    """Cache of the ``userinfo`` of the users on each system
+
+    Entries are keyed by ``(username, firecrest_url, host)`` and kept for
+    the time-to-live given on lookup. Concurrent lookups of the same key
+    share one request.
+    """
+
+    _entries = {}
+    _pending = {}
+
+    @classmethod
+    async def get(cls, key, fetch, ttl: float) -> dict:
+        """Return the cached userinfo of ``key`` or the one obtained by
+        awaiting ``fetch()`` if it's older than ``ttl`` seconds"""
+        entry = cls._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < ttl:
+            return entry[1]
+
+        pending = cls._pending.get(key)
+        if pending is None:
+            pending = cls._pending[key] = asyncio.ensure_future(
+                cls._fetch(key, fetch)
+            )
+
+        return await asyncio.shield(pending)
+
+    @classmethod
+    async def _fetch(cls, key, fetch) -> dict:
+        try:
+            userinfo = await fetch()
+            cls._entries[key] = (time.monotonic(), userinfo)
+            return userinfo
+        finally:
+            cls._pending.pop(key, None)
+
+    @classmethod
+    def invalidate(cls, key) -> None:
+        """Drop the entry of ``key``"""
+        cls._entries.pop(key, None)
+
+    @classmethod
+    def clear(cls) -> None:
+        """Drop all the entries"""
+        cls._entries.clear()
+        cls._pending.clear()
+
+
+class WarmPool:
+    """Pool of pre-allocated jobs handed over to the spawners
+
+    :param host: name of the system where the jobs run
+    :param client_factory: coroutine function returning the client that
+                           owns the pool's allocations (typically a service
+                           account client)
+    :param script: batch script of the allocations
+    :param working_dir: working directory of the allocations
+    :param log: logger used by the background tasks
+    :param size: number of allocations kept in the pool
+    :param refill_interval: minimum time in seconds between two submissions
+    :param idle_timeout: time in seconds after which an allocation that
+                         hasn't been handed over is cancelled
+    :param job_name: name of the allocations in the scheduler
+    :param firecrest_url: URL of the FireCREST managing the allocations
+
+    The allocations only keep the nodes busy. A spawner acquiring one of
+    them starts the single-user server in a job step with
+    ``attach_to_job``, which requires the scheduler to let the user run
+    steps in an allocation owned by the pool's account.
+
+    The pool only lives in the hub's memory. When the hub starts, the
+    allocations named ``job_name`` that aren't in use by a restored
+    server are cancelled before the pool is refilled.
+    """
+
+    _pools = {}
+
+    # allocations handed over to the spawners
+    _handed_over = set()
+
+    # cancellation of the allocations left by a previous run of the hub,
+    # by (firecrest_url, host)
+    _reconciled = {}
+
+    def __init__(
+        self,
+        host: str,
+        client_factory,
+        script: str,
+        working_dir: str,
+        log,
+        size: int = 1,
+        refill_interval: float = 30,
+        idle_timeout: float = 3600,
+        job_name: str = "spawner-jupyterhub-pool",
+        firecrest_url: str = "",
+    ):
+        self.host = host
+        self.client_factory = client_factory
+        self.script = script
+        self.working_dir = working_dir
+        self.log = log
+        self.size = size
+        self.refill_interval = refill_interval
+        self.idle_timeout = idle_timeout
+        self.job_name = job_name
+        self.firecrest_url = firecrest_url
+        # job id -> submission time
+        self.jobs = {}
+        # allocations taken out of the pool that haven't been handed
+        # over yet, with their submission time
+        self.acquired = {}
+        self.hits = 0
+        self.misses = 0
+        self._last_submission = None
+        self._maintaining = None
+
+    @classmethod
+    def get_pool(cls, firecrest_url, host, script, **kwargs):
+        """Returns the pool of the allocations of a host requested with
+        ``script``, creating it if needed
+
+        Since the script has all the resources requested for the
+        allocations, a spawn only gets an allocation of the pool whose
+        resources match the ones it requests.
+        """
+        key = (firecrest_url, host, script)
+        pool = cls._pools.get(key)
+        if pool is None:
+            pool = cls._pools[key] = cls(
+                host, script=script, firecrest_url=firecrest_url, **kwargs
+            )
+
+        return pool
+
+    @classmethod
+    def maintain_all(cls) -> None:
+        """Cancel the idle allocations and refill all the pools in the
+        background"""
+        for pool in cls._pools.values():
+            pool.maintain()
+
+    @classmethod
+    def hand_over(cls, job_id) -> None:
+        """Record that an allocation is used by a spawner"""
+        cls._handed_over.add(str(job_id))
+        for pool in cls._pools.values():
+            pool.acquired.pop(str(job_id), None)
+
+    @classmethod
+    def release(cls, job_id) -> None:
+        """Record that an allocation is no longer used by a spawner"""
+        cls._handed_over.discard(str(job_id))
+
+    @classmethod
+    def clear(cls) -> None:
+        """Drop all the pools without cancelling their allocations"""
+        cls._pools.clear()
+        cls._handed_over.clear()
+        cls._reconciled.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of the spawns that got an allocation from the pool"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def record_hit(self) -> None:
+        self.hits += 1
+        WARM_POOL_ACQUISITIONS.labels(host=self.host, outcome="hit").inc()
+
+    def record_miss(self) -> None:
+        self.misses += 1
+        WARM_POOL_ACQUISITIONS.labels(host=self.host, outcome="miss").inc()
+
+    def update_metrics(self) -> None:
+        """Set the gauge of the allocations waiting in the pools of the
+        host"""
+        WARM_POOL_JOBS.labels(host=self.host).set(sum(
+            len(pool.jobs) for pool in self._pools.values()
+            if pool.host == self.host
+        ))
+
+    async def acquire(self) -> Optional[str]:
+        """Take a running allocation out of the pool
+
+        Returns the job id of the allocation or ``None`` if none is running.
+        The pool is refilled in the background.
+        """
+        job_id = None
+        if self.jobs:
+            # the allocations submitted while the listing is requested
+            # aren't part of it
+            known = list(self.jobs)
+            client = await self.client_factory()
+            jobs = {
+                str(job["jobId"]): JobState.from_job_info(job)
+                for job in await client.job_info(self.host)
+            }
+            # forget the allocations that ended
+            for pool_job_id in known:
+                if pool_job_id not in jobs:
+                    self.jobs.pop(pool_job_id, None)
+
+            job_id = next(
+                (pool_job_id for pool_job_id in known
+                 if pool_job_id in self.jobs and
+                 jobs[pool_job_id].state == SlurmJobState.RUNNING),
+                None
+            )
+            if job_id is not None:
+                self.acquired[job_id] = self.jobs.pop(job_id)
+
+        self.update_metrics()
+        self.maintain()
+        return job_id
+
+    def put_back(self, job_id) -> None:
+        """Return an acquired allocation that couldn't be used to the pool
+
+        It keeps its submission time, so its idle timeout isn't extended.
+        """
+        self.jobs[job_id] = self.acquired.pop(job_id, time.monotonic())
+        self.update_metrics()
+
+    def maintain(self) -> None:
+        """Cancel the idle allocations and refill the pool in the
+        background"""
+        if self._maintaining is None or self._maintaining.done():
+            self._maintaining = asyncio.ensure_future(self._maintain())
+
+    async def _maintain(self) -> None:
+        try:
+            # the leftovers are identified before submitting new allocations
+            await asyncio.shield(WarmPool.reconcile(
+                self.firecrest_url, self.host, self.client_factory,
+                self.job_name, self.log
+            ))
+            client = await self.client_factory()
+            now = time.monotonic()
+            for job_id, submitted in list(self.jobs.items()):
+                if now - submitted > self.idle_timeout:
+                    self.log.info(f"Cancelling idle warm pool job {job_id}")
+                    del self.jobs[job_id]
+                    await client.cancel_job(self.host, job_id)
+
+            while len(self.jobs) < self.size:
+                if self._last_submission is not None:
+                    wait = (self._last_submission + self.refill_interval
+                            - time.monotonic())
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+
+                self._last_submission = time.monotonic()
+                job = await client.submit(
+                    self.host,
+                    script_str=self.script,
+                    working_dir=self.working_dir,
+                )
+                self.jobs[str(job["jobId"])] = time.monotonic()
+                self.log.info(f"Warm pool job {job['jobId']} submitted")
+        except Exception as e:
+            self.log.warning(f"Could not maintain the warm pool: {e}")
+        finally:
+            self.update_metrics()
+
+    @classmethod
+    def reconcile(cls, firecrest_url, host, client_factory, job_name,
+                  log) -> asyncio.Future:
+        """Cancel the allocations left by a previous run of the hub
+
+        It's done once per host, in the background. The allocations named
+        ``job_name`` that are neither in a pool nor in use by a spawner
+        restored from the hub's database are cancelled. If it fails, it's
+        retried on the next call.
+        """
+        key = (firecrest_url, host)
+        task = cls._reconciled.get(key)
+        if task is None:
+            task = cls._reconciled[key] = asyncio.ensure_future(
+                cls._cancel_orphans(host, client_factory, job_name, log)
+            )
+
+            def done(task):
+                if task.cancelled() or task.exception() is not None:
+                    if not task.cancelled():
+                        log.warning("Could not cancel the leftover warm pool "
+                                    f"jobs: {task.exception()}")
+                    if cls._reconciled.get(key) is task:
+                        del cls._reconciled[key]
+
+            task.add_done_callback(done)
+
+        return task
+
+    @classmethod
+    async def _cancel_orphans(cls, host, client_factory, job_name,
+                              log) -> None:
+        client = await client_factory()
+        for job in await client.job_info(host):
+            job_id = str(job["jobId"])
+            in_pool = any(job_id in pool.jobs or job_id in pool.acquired
+                          for pool in cls._pools.values())
+            if (job.get("name") != job_name or in_pool or
+                    job_id in cls._handed_over or
+                    JobState.from_job_info(job).is_finished):
+                continue
+
+            log.info(f"Cancelling warm pool job {job_id} left by a "
+                     "previous run of the hub")
+            await client.cancel_job(host, job_id)
+
+
+def prefetch_userinfo(authenticator, handler, authentication):
+    """Post-authentication hook warming the userinfo cache of the user
+
+    It can be set as the authenticator's ``post_auth_hook``. The userinfo
+    of the user's default spawner host is requested in the background,
+    so the login isn't delayed and the value is usually cached by the
+    time the user submits the options form.
+    """
+    name = authentication["name"]
+
+    async def prefetch():
+        # the user and its auth state are stored once the hook returns
+        for _ in range(20):
+            user = handler.find_user(name)
+            if user is not None and await user.get_auth_state():
+                break
+
+            await asyncio.sleep(0.5)
+        else:
+            return
+
+        try:
+            await user.spawner.prefetch_userinfo()
+        except Exception as e:
+            authenticator.log.warning(
+                f"Could not prefetch the userinfo of {name}: {e}"
+            )
+
+    asyncio.ensure_future(prefetch())
+    return authentication
+
+
+async def get_node_ip_from_output(spawner, num_lines=5, max_delay=10):
+    """Fetch the ip of the node where the single-user server is running
+    from the first lines of the job's output file.
+
+    This expects that `hostname -i` is called at the begining
+    of the job. It can be used as ``custom_state_gethost``.
+
+    The output file is read with the same FirecREST client until an
+    address is found, waiting with exponential backoff between attempts
+    while the file is not available yet. A `TimeoutError` is raised if
+    no address is found within the spawner's ``start_timeout``.
+    """
+    deadline = time.monotonic() + spawner.start_timeout
+    client = await spawner.get_firecrest_client()
+    output_file = (getattr(spawner, "job", None) or {}).get("job_file_out")
+    delay = 1
+    while True:
+        try:
+            if not output_file:
+                with observe_request("job_metadata", spawner.host):
+                    metadata = await client.job_metadata(spawner.host,
+                                                         spawner.job_id)
+                output_file = metadata[0]["standardOutput"]
+
+            spawner.log.info("firecREST: Running `client.head` "
+                             "to fetch the ip")
+            output = await client.head(spawner.host, output_file,
+                                       num_lines=num_lines)
+            if isinstance(output, dict):
+                output = output.get("content", "")
+
+            ip = parse_node_ip(output)
+            if ip:
+                return ip
+
+            spawner.log.info(f"No IP address in the job's output yet: "
+                             f"{output_file}")
+        except (FirecrestException, httpx.TransportError) as e:
+            spawner.log.info(f"Job output file not available yet: {e}")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(
+                f"Could not find the IP of the node of job {spawner.job_id} "
+                f"in its output within {spawner.start_timeout} seconds"
+            )
+
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
 
 
 class FirecRESTSpawnerBase(Spawner):
@@ -148,6 +1694,14 @@ class FirecRESTSpawnerBase(Spawner):
         "button availability"
     )
 
+    access_token_check_interval = Float(
+        60,
+        help="Seconds during which the result of the check of the user's "
+        "credentials done by ``poll()`` is reused",
+    ).tag(config=True)
+
+    _access_token_checked = None
+
     workdir = Unicode(
         "/users",
         help="Directory where the job will be submitted from"
@@ -246,28 +1800,272 @@ class FirecRESTSpawnerBase(Spawner):
     def _req_username_default(self):
         return self.user.name
 
-    req_homedir = Unicode()
+    req_homedir = Unicode()
+
+    batch_script = Unicode(
+        "",
+        help="Template for job submission script. "
+        "Traits on this class named like ``req_xyz`` will be substituted in "
+        "the template for ``{xyz}`` using ``string.Formatter``. "
+        "Must include ``{cmd}`` which will be replaced with the "
+        "``jupyterhub-singleuser`` command line.",
+    ).tag(config=True)
+
+    @validate("batch_script")
+    def _validate_batch_script(self, proposal):
+        # compile the template when the configuration is loaded
+        # so that syntax errors don't show up on the first spawn
+        template = proposal["value"]
+        if is_jinja2_template(template):
+            try:
+                compile_template(template)
+            except TemplateSyntaxError as e:
+                raise TraitError(
+                    f"Invalid batch_script template (line {e.lineno}): "
+                    f"{e.message}"
+                )
+
+        return template
+
+    batchspawner_singleuser_cmd = Unicode(
+        "batchspawner-singleuser",
+        help="A wrapper which is capable of special batchspawner setup: "
+        "currently sets the port on the remote host. "
+        "Not needed to be set under normal circumstances, unless path "
+        "needs specification.",
+    ).tag(config=True)
+
+    startup_access_token_check_spread = Float(
+        60,
+        help="Seconds over which the first checks of the credentials of the "
+        "servers restored from the hub's database are spread, to avoid "
+        "checking the credentials of all the users at once when the hub "
+        "restarts",
+    ).tag(config=True)
+
+    access_token_min_validity = Float(
+        30,
+        help="Seconds before the expiration of the user's access token at "
+        "which it's refreshed",
+    ).tag(config=True)
+
+    circuit_breaker_failure_threshold = Integer(
+        5,
+        help="Number of consecutive failed requests to FireCREST or to the "
+        "authorization server after which further requests fail "
+        "immediately for ``circuit_breaker_reset_timeout`` seconds. "
+        "Set to 0 to disable the circuit breakers.",
+    ).tag(config=True)
+
+    circuit_breaker_reset_timeout = Float(
+        30,
+        help="Seconds during which the requests to a failing service fail "
+        "immediately before a single request is let through to probe it",
+    ).tag(config=True)
+
+    circuit_breaker_latency_threshold = Float(
+        10,
+        help="Requests taking longer than this number of seconds count as "
+        "failed for the circuit breakers",
+    ).tag(config=True)
+
+    firecrest_rate_limits = Dict(
+        {},
+        help="Maximum average number of requests per second sent by the hub "
+        "to each FireCREST service group, e.g. "
+        "``{'compute': 5, 'status': 5, 'filesystem': 5}``. The requests to a "
+        "group that isn't listed aren't limited. By default, no limits are "
+        "applied.",
+    ).tag(config=True)
+
+    firecrest_rate_limit_burst = Integer(
+        10,
+        help="Number of requests to a FireCREST service group that can be "
+        "sent at once after a period without requests",
+    ).tag(config=True)
+
+    firecrest_max_in_flight = Integer(
+        20,
+        help="Maximum number of concurrent requests sent by the hub to "
+        "each FireCREST service group",
+    ).tag(config=True)
+
+    event_loop_monitor = Bool(
+        False,
+        help="Measure the lag of the hub's event loop and report the spawner "
+        "methods blocking it for longer than ``event_loop_lag_threshold``",
+    ).tag(config=True)
+
+    event_loop_monitor_interval = Float(
+        0.5,
+        help="Seconds between two measurements of the lag of the event loop",
+    ).tag(config=True)
+
+    event_loop_lag_threshold = Float(
+        0.1,
+        help="Lag of the event loop in seconds above which the call "
+        "blocking it is reported",
+    ).tag(config=True)
+
+    firecrest_max_connections = Integer(
+        100,
+        help="Maximum number of connections of the HTTP connection pool "
+        "shared by all the firecrest clients",
+    ).tag(config=True)
+
+    firecrest_max_keepalive_connections = Integer(
+        20,
+        help="Maximum number of idle connections kept alive in the HTTP "
+        "connection pool shared by all the firecrest clients",
+    ).tag(config=True)
+
+    firecrest_keepalive_expiry = Float(
+        30,
+        help="Seconds after which an idle connection of the HTTP connection "
+        "pool is closed",
+    ).tag(config=True)
+
+    firecrest_http2 = Bool(
+        False,
+        help="If ``True``, use HTTP/2 for the requests to FirecREST. "
+        "It requires the ``h2`` package.",
+    ).tag(config=True)
+
+    firecrest_client_idle_timeout = Float(
+        3600,
+        help="Seconds after which a firecrest client that hasn't been used "
+        "is removed from the registry of shared clients",
+    ).tag(config=True)
+
+    polling_with_service_account = Bool(
+        True,
+        help="If ``True``, use a service account client for job polling.",
+    ).tag(config=True)
+
+    batch_polling = Bool(
+        False,
+        help="If ``True``, and ``polling_with_service_account`` is also "
+        "``True``, the status of the jobs is obtained from a listing of the "
+        "jobs of all users shared by all spawners instead of polling "
+        "each job individually.",
+    ).tag(config=True)
+
+    batch_poll_interval = Float(
+        5.0,
+        help="Maximum age in seconds of the shared jobs listing used when "
+        "``batch_polling`` is enabled",
+    ).tag(config=True)
+
+    warm_pool_size = Integer(
+        0,
+        help="Number of allocations kept in a pool per resource profile "
+        "(the batch script of the allocations). A spawn gets a running "
+        "allocation from the pool if there's one and starts the single-user "
+        "server in a job step, with a launcher script that only the user "
+        "can read (see ``upload_step_launcher``). The pool's allocations "
+        "are owned by the service account, so the scheduler must let users "
+        "run steps in them. Set to 0 to disable the pool.",
+    ).tag(config=True)
+
+    warm_pool_batch_script = Unicode(
+        "",
+        help="Template for the batch script of the pool's allocations. "
+        "It's formatted like ``batch_script`` with the ``req_xyz`` traits "
+        "and ``job_name``. It should request all the resources requested by "
+        "``batch_script``, since the allocations are only handed over to the "
+        "spawns whose resources render the same script.",
+    ).tag(config=True)
+
+    warm_pool_job_name = Unicode(
+        "spawner-jupyterhub-pool",
+        help="Name of the pool's allocations in the scheduler. The "
+        "allocations with this name that aren't in use when the hub starts "
+        "are cancelled.",
+    ).tag(config=True)
+
+    warm_pool_refill_interval = Float(
+        30,
+        help="Minimum time in seconds between two submissions of "
+        "allocations for the pool",
+    ).tag(config=True)
+
+    warm_pool_idle_timeout = Float(
+        3600,
+        help="Time in seconds after which an allocation of the pool that "
+        "hasn't been used is cancelled",
+    ).tag(config=True)
+
+    warm_pool_job = Bool(
+        False,
+        help="Whether the current job is an allocation of the warm pool",
+    )
+
+    userinfo_cache_ttl = Float(
+        600,
+        help="Time in seconds during which the userinfo of a user on a "
+        "system, used to set the default account of the job, is reused "
+        "across spawns. Set to 0 to request it on every spawn.",
+    ).tag(config=True)
+
+    poll_max_retries = Integer(
+        5,
+        help="Maximum number of times a failed request for the state of "
+        "a job is retried",
+    ).tag(config=True)
+
+    poll_retry_delay = Float(
+        1,
+        help="Seconds to wait before retrying a failed request for the "
+        "state of a job. It grows by ``poll_retry_backoff`` on each retry.",
+    ).tag(config=True)
+
+    poll_retry_backoff = Float(
+        2,
+        help="Factor by which the time between retries of a request for the "
+        "state of a job grows",
+    ).tag(config=True)
+
+    poll_retry_max_delay = Float(
+        10,
+        help="Maximum time in seconds between retries of a request for the "
+        "state of a job",
+    ).tag(config=True)
+
+    poll_time_budget = Float(
+        30,
+        help="Maximum time in seconds spent retrying the requests for the "
+        "state of a job. When it runs out, the job is considered not found "
+        "if FirecREST reported it as missing, or in an unknown state "
+        "otherwise.",
+    ).tag(config=True)
+
+    stop_confirm_delay = Float(
+        1,
+        help="Seconds to wait before checking that a cancelled job is gone. "
+        "The time between checks doubles up to ``stop_confirm_max_delay``.",
+    ).tag(config=True)
+
+    stop_confirm_max_delay = Float(
+        10,
+        help="Maximum time in seconds between the checks of a cancelled job",
+    ).tag(config=True)
 
-    batch_script = Unicode(
-        "",
-        help="Template for job submission script. "
-        "Traits on this class named like ``req_xyz`` will be substituted in "
-        "the template for ``{xyz}`` using ``string.Formatter``. "
-        "Must include ``{cmd}`` which will be replaced with the "
-        "``jupyterhub-singleuser`` command line.",
+    stop_confirm_timeout = Float(
+        60,
+        help="Time in seconds after which a cancelled job that is still in "
+        "the queue is cancelled again",
     ).tag(config=True)
 
-    batchspawner_singleuser_cmd = Unicode(
-        "batchspawner-singleuser",
-        help="A wrapper which is capable of special batchspawner setup: "
-        "currently sets the port on the remote host. "
-        "Not needed to be set under normal circumstances, unless path "
-        "needs specification.",
+    bulk_cancel_concurrency = Integer(
+        10,
+        help="Maximum number of concurrent requests cancelling jobs with the "
+        "same FireCREST credentials when stopping servers in bulk",
     ).tag(config=True)
 
-    polling_with_service_account = Bool(
-        True,
-        help="If ``True``, use a service account client for job polling.",
+    stop_cancel_retries = Integer(
+        2,
+        help="Number of times a job that survives its cancellation is "
+        "cancelled again before reporting it",
     ).tag(config=True)
 
     # Raw output of job submission command unless overridden
@@ -276,32 +2074,161 @@ class FirecRESTSpawnerBase(Spawner):
     # Will get the raw output of the job status command unless overridden
     job_status = Unicode()
 
+    # Last state of the job obtained from FirecREST
+    job_state = None
+
+    spawn_timeline = Dict(
+        help="Time at which each phase of the last spawn was reached, as "
+        "seconds since the epoch. The phases are ``start``, "
+        "``token_acquired``, ``userinfo_done``, ``script_rendered``, "
+        "``submitted``, ``pending``, ``running``, ``host_resolved`` and "
+        "``server_reported`` (the single-user server reported its port "
+        "to the hub).",
+    )
+
+    # State of the job counted in the jobs gauge and time of the
+    # submission, to observe the time spent in the queue
+    _job_metrics_state = None
+    _submitted = None
+
+    # Set by ``firecrestspawner-singleuser`` through the hub's API when
+    # the single-user server starts
+    node_ip = Unicode()
+    node_hostname = Unicode()
+
+    singleuser_callback_address = EnumTrait(
+        ["hostname", "ip", ""],
+        default_value="",
+        help="Address of the node reported by ``firecrestspawner-singleuser`` "
+        "that is used to connect to the single-user server. With "
+        "``hostname``, the node's hostname is formatted with "
+        "``node_name_template`` (if set). With ``ip``, the node's IP is used. "
+        "With ``''`` (the default), or if the single-user server doesn't "
+        "report it, the node is obtained by polling the job and "
+        "``state_gethost`` (or ``custom_state_gethost``).",
+    ).tag(config=True)
+
+    _node_ready = None
+
+    @property
+    def node_ready(self) -> asyncio.Event:
+        """Event set when the single-user server reports its node"""
+        if self._node_ready is None:
+            self._node_ready = asyncio.Event()
+
+        return self._node_ready
+
+    @observe("node_ip", "node_hostname")
+    def _node_reported(self, change):
+        if change["new"]:
+            self.node_ready.set()
+
+    # job cancelled by ``cancel_jobs``, which ``stop`` doesn't cancel again
+    _cancelled_job_id = None
+
+    # background tasks confirming that the stopped jobs are gone,
+    # referenced until they finish
+    _stop_confirmations = set()
+
+    # spawners by API token, to find the spawner of the requests done by
+    # the single-user servers without going through all the spawners
+    _spawners_by_api_token = weakref.WeakValueDictionary()
+
+    @observe("api_token")
+    def _index_api_token(self, change):
+        index = FirecRESTSpawnerBase._spawners_by_api_token
+        if change["old"] and index.get(change["old"]) is self:
+            del index[change["old"]]
+        if change["new"]:
+            index[change["new"]] = self
+
+    @classmethod
+    def find_by_api_token(cls, token: str) -> Optional[Spawner]:
+        """Returns the spawner whose server uses an API token"""
+        if not token:
+            return None
+
+        spawner = FirecRESTSpawnerBase._spawners_by_api_token.get(token)
+        # the token may have been replaced by a new spawn
+        if spawner is not None and spawner.api_token == token:
+            return spawner
+
+        return None
+
+    def reset_node(self) -> None:
+        """Forget the node reported by the single-user server"""
+        self.node_ip = ""
+        self.node_hostname = ""
+        self.node_ready.clear()
+
+    def callback_host(self) -> str:
+        """Returns the address of the node reported by the single-user
+        server according to ``singleuser_callback_address`` or ``""``"""
+        if self.singleuser_callback_address == "ip":
+            return self.node_ip
+
+        if self.singleuser_callback_address == "hostname" and self.node_hostname:
+            template = getattr(self, "node_name_template", "") or "{}"
+            return template.format(self.node_hostname)
+
+        return ""
+
+    async def wait_for_node(self, timeout: float) -> bool:
+        """Wait up to ``timeout`` seconds for the single-user server to report
+        its node. Returns boolean indicating if it did."""
+        if not self.singleuser_callback_address:
+            await asyncio.sleep(timeout)
+            return False
+
+        deadline = time.monotonic() + timeout
+        try:
+            await asyncio.wait_for(self.node_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        if self.callback_host():
+            return True
+
+        # the report didn't include the address, so the rest of the delay
+        # is waited to not poll FireCREST in a tight loop
+        await asyncio.sleep(max(deadline - time.monotonic(), 0))
+        return False
+
+    @classmethod
+    def req_trait_names(cls) -> tuple:
+        """Names of the ``req_xyz`` traits of the class, computed once
+        per class"""
+        names = cls.__dict__.get("_req_trait_names")
+        if names is None:
+            names = tuple(t for t in cls.class_trait_names()
+                          if t.startswith("req_"))
+            cls._req_trait_names = names
+
+        return names
+
     def get_req_subvars(self):
         """Prepare substitution variables for templates using ``req_xyz``
         traits.
         """
-        reqlist = [t for t in self.trait_names() if t.startswith("req_")]
-        subvars = {}
-        for t in reqlist:
-            subvars[t[4:]] = getattr(self, t)
-
-        return subvars
+        return {t[4:]: getattr(self, t) for t in self.req_trait_names()}
 
     def cmd_formatted_for_batch(self):
         """The command which is substituted inside of the batch script."""
         return " ".join(self.cmd)
 
-    async def get_firecrest_client(self):
-        """Returns a firecrest client that uses Keycloak's Authorization Code
-        Flow method"""
+    async def get_authorization(self) -> AuthorizationCodeFlowAuth:
+        """Returns the user's authorization object, shared by all the
+        spawners of the user"""
         auth_state = await self.user.get_auth_state()
 
         try:
-            auth = AuthorizationCodeFlowAuth(
+            auth = AuthorizationCodeFlowAuth.get_auth(
+                username=self.user.name,
                 client_id=self.user.authenticator.client_id,
                 client_secret=self.user.authenticator.client_secret,
                 refresh_token=auth_state["refresh_token"],
                 token_url=self.user.authenticator.token_url,
+                min_token_validity=self.access_token_min_validity,
             )
         except TypeError as e:
             # If `auth_state` is None, then `auth_state["refresh_token"]` can
@@ -313,22 +2240,206 @@ class FirecRESTSpawnerBase(Spawner):
                                 "log back in to refresh the credentials.")
             raise err
 
-        client = Firecrest(
-            firecrest_url=self.firecrest_url, authorization=auth
+        auth.on_refresh_token = self.save_refresh_token
+        return auth
+
+    async def save_refresh_token(self, refresh_token: str) -> None:
+        """Write a rotated refresh token back to the user's ``auth_state``"""
+        auth_state = await self.user.get_auth_state()
+        if auth_state and auth_state.get("refresh_token") != refresh_token:
+            auth_state["refresh_token"] = refresh_token
+            await self.user.save_auth_state(auth_state)
+            self.log.debug(f"Refresh token of {self.user.name} updated")
+
+    def _firecrest_session_kwargs(self) -> dict:
+        return dict(
+            max_connections=self.firecrest_max_connections,
+            max_keepalive_connections=self.firecrest_max_keepalive_connections,
+            keepalive_expiry=self.firecrest_keepalive_expiry,
+            http2=self.firecrest_http2,
+        )
+
+    def get_circuit_breaker(self, name: str) -> Optional[CircuitBreaker]:
+        """Returns the circuit breaker of a service or ``None`` if circuit
+        breaking is disabled"""
+        if self.circuit_breaker_failure_threshold <= 0:
+            return None
+
+        return CircuitBreaker.get_breaker(
+            name,
+            failure_threshold=self.circuit_breaker_failure_threshold,
+            reset_timeout=self.circuit_breaker_reset_timeout,
+            latency_threshold=self.circuit_breaker_latency_threshold,
+            log=self.log,
         )
 
-        client.time_between_calls = {
-            "compute": 0,
-            "reservations": 0,
-            "status": 0,
-            "storage": 0,
-            "tasks": 0,
-            "utilities": 0,
+    def get_rate_limiters(self) -> Optional[dict]:
+        """Returns the rate limiters of the FireCREST service groups or
+        ``None`` if the requests aren't limited"""
+        if not self.firecrest_rate_limits:
+            return None
+
+        return {
+            group: RateLimiter.get_limiter(
+                self.firecrest_url,
+                group,
+                rate=rate,
+                burst=self.firecrest_rate_limit_burst,
+                max_in_flight=self.firecrest_max_in_flight,
+            )
+            for group, rate in self.firecrest_rate_limits.items()
         }
 
-        client.timeout = 30
+    async def get_firecrest_client(self):
+        """Returns a firecrest client that uses Keycloak's Authorization Code
+        Flow method"""
+        auth = await self.get_authorization()
+        auth.http_client = FirecrestClientRegistry.get_session(
+            **self._firecrest_session_kwargs()
+        )
+        auth.circuit_breaker = self.get_circuit_breaker(auth.token_url)
+        # fail early if the credentials have expired
+        await auth.async_get_access_token()
+
+        client = FirecrestClientRegistry.get_client(
+            ("user", self.user.name, auth.token_url),
+            self.firecrest_url,
+            auth,
+            idle_timeout=self.firecrest_client_idle_timeout,
+            **self._firecrest_session_kwargs()
+        )
+        client.circuit_breaker = self.get_circuit_breaker(self.firecrest_url)
+        client.rate_limiters = self.get_rate_limiters()
         return client
 
+    def get_warm_pool(self, subvars: dict) -> Optional[WarmPool]:
+        """Returns the warm pool matching the resources of the job, or
+        ``None`` if the pool is disabled"""
+        if self.warm_pool_size <= 0 or not self.warm_pool_batch_script:
+            return None
+
+        subvars = dict(subvars, job_name=self.warm_pool_job_name)
+        return WarmPool.get_pool(
+            self.firecrest_url,
+            subvars["host"],
+            format_template(self.warm_pool_batch_script, **subvars),
+            client_factory=self.get_firecrest_client_service_account,
+            working_dir=self.workdir,
+            log=self.log,
+            size=self.warm_pool_size,
+            refill_interval=self.warm_pool_refill_interval,
+            idle_timeout=self.warm_pool_idle_timeout,
+            job_name=self.warm_pool_job_name,
+        )
+
+    async def upload_step_launcher(self, client, job_id: str,
+                                   job_env: dict) -> str:
+        """Upload the script starting the single-user server in a job step
+        of a warm pool allocation
+
+        The environment of the server, which has its API token and OAuth
+        client secret, is written in the script instead of the step's
+        command line, where any user of the node could read it. The script
+        is uploaded to a directory that only the user can access and it
+        removes itself when it runs.
+
+        Returns the path of the script.
+        """
+        directory = "/".join((self.workdir, self.user.name,
+                              ".firecrestspawner"))
+        name = f"launch-{job_id}.sh"
+        lines = ["#!/bin/bash", 'rm -f "$0"']
+        lines.extend(f"export {key}={shlex.quote(value)}"
+                     for key, value in self.encode_job_env(job_env).items())
+        lines.extend([
+            "export JUPYTERHUB_OAUTH_ACCESS_SCOPES=$(echo "
+            "$JUPYTERHUB_OAUTH_ACCESS_SCOPES | base64 --decode)",
+            "export JUPYTERHUB_OAUTH_SCOPES=$(echo "
+            "$JUPYTERHUB_OAUTH_SCOPES | base64 --decode)",
+            f"exec {self.cmd_formatted_for_batch()}",
+        ])
+
+        await client.mkdir(self.host, directory, create_parents=True)
+        await client.chmod(self.host, directory, "700")
+        # ``mkdtemp`` creates the directory only readable by the hub
+        with tempfile.TemporaryDirectory() as local_dir:
+            local_path = os.path.join(local_dir, name)
+            with open(local_path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+
+            await client.upload(self.host, local_path, directory, name)
+
+        path = f"{directory}/{name}"
+        await client.chmod(self.host, path, "700")
+        return path
+
+    async def start_in_warm_pool(self, pool: WarmPool, client,
+                                 job_env: dict) -> bool:
+        """Start the single-user server in a job step of an allocation of
+        the warm pool
+
+        Returns whether the server was started. If it wasn't, a new job
+        must be submitted.
+        """
+        try:
+            job_id = await pool.acquire()
+        except Exception as e:
+            self.log.warning(f"Could not get a job from the warm pool: {e}")
+            job_id = None
+
+        if job_id is None:
+            pool.record_miss()
+            return False
+
+        try:
+            launcher = await self.upload_step_launcher(client, job_id,
+                                                       job_env)
+            self.log.info(f"firecREST: Attaching to warm pool job {job_id}")
+            await client.attach_to_job(self.host, job_id, launcher)
+        except Exception as e:
+            self.log.warning(
+                f"Could not start the server in warm pool job {job_id}: {e}"
+            )
+            pool.record_miss()
+            pool.put_back(job_id)
+            return False
+
+        pool.record_hit()
+        WarmPool.hand_over(job_id)
+        self.log.info(
+            f"Server started in warm pool job {job_id} "
+            f"(hit rate: {pool.hit_rate:.2f})"
+        )
+        self.job = {"jobId": job_id}
+        self.job_id = job_id
+        self.warm_pool_job = True
+        return True
+
+    async def get_userinfo(self, host: str, client=None) -> dict:
+        """Returns the userinfo of the user on ``host``
+
+        The result is cached for ``userinfo_cache_ttl`` seconds.
+        """
+        async def fetch():
+            nonlocal client
+            if client is None:
+                client = await self.get_firecrest_client()
+
+            self.log.info(f"firecREST: Requesting userinfo on {host}")
+            with observe_request("userinfo", host):
+                return await client.userinfo(host)
+
+        return await UserInfoCache.get(
+            (self.user.name, self.firecrest_url, host),
+            fetch,
+            self.userinfo_cache_ttl,
+        )
+
+    async def prefetch_userinfo(self) -> None:
+        """Fill the userinfo cache for the default host"""
+        if self.userinfo_cache_ttl > 0 and self.req_host:
+            await self.get_userinfo(self.req_host)
+
     async def get_firecrest_client_service_account(self):
         """Returns a firecrest client that uses the Client Credentials
         Authorization method
@@ -337,54 +2448,134 @@ class FirecRESTSpawnerBase(Spawner):
         client_secret = os.environ["SA_CLIENT_SECRET"]
         token_url = os.environ["SA_AUTH_TOKEN_URL"]
 
-        auth = ClientCredentialsAuth(
-            client_id,
-            client_secret,
+        identity = ("service-account", client_id, token_url)
+        client = FirecrestClientRegistry.get_client(
+            identity,
+            self.firecrest_url,
+            None,
+            idle_timeout=self.firecrest_client_idle_timeout,
+            **self._firecrest_session_kwargs()
+        )
+        client.circuit_breaker = self.get_circuit_breaker(self.firecrest_url)
+        client.rate_limiters = self.get_rate_limiters()
+        if client._authorization is None:
+            # ``ClientCredentialsAuth`` caches the token, so it's kept
+            # with the client
+            client._authorization = AsyncClientCredentialsAuth(
+                client_id,
+                client_secret,
+                token_url
+            )
+
+        client._authorization.circuit_breaker = self.get_circuit_breaker(
             token_url
         )
+        return client
+
+    @property
+    def job_status_poller(self) -> Optional[JobStatusPoller]:
+        """The poller shared by the spawners of the same host or ``None``
+        if ``batch_polling`` is not in use"""
+        if not (self.batch_polling and self.polling_with_service_account):
+            return None
 
-        client = Firecrest(
-            firecrest_url=self.firecrest_url, authorization=auth
+        # ``self.host`` is only set once the job is submitted or polled
+        return JobStatusPoller.get_poller(
+            self.firecrest_url,
+            getattr(self, "host", self.req_host),
+            self.get_firecrest_client_service_account,
+            self.batch_poll_interval
         )
 
-        client.time_between_calls = {
-            "compute": 0,
-            "reservations": 0,
-            "status": 0,
-            "storage": 0,
-            "tasks": 0,
-            "utilities": 0,
-        }
+    async def firecrest_poll(self) -> Optional[list]:
+        """Helper function to poll jobs.
 
-        client.timeout = 30
-        return client
+        Failed requests are retried up to ``poll_max_retries`` times with
+        exponential backoff, within ``poll_time_budget`` seconds. When giving
+        up, it returns ``[]`` if the job was not found and ``None`` if its
+        state couldn't be obtained.
+        """
+
+        poller = self.job_status_poller
+        if poller is not None and not poller.is_backing_off():
+            try:
+                poll_result = await poller.job_info(self.job_id)
+                if poll_result:
+                    return poll_result
+            except Exception as e:
+                self.log.info(f"Polling jobs listing fail: {e}")
 
-    async def firecrest_poll(self):
-        """Helper function to poll jobs."""
+            # The job is not part of the listing (e.g. it has just been
+            # submitted or it has already finished). Fall back to polling
+            # it individually
 
         if self.polling_with_service_account:
             client = await self.get_firecrest_client_service_account()
         else:
             client = await self.get_firecrest_client()
 
-        # This is needed in case the scheduler is slow updating
-        # its database which could make the result of ``client.poll``
-        # to be an empty list
-        poll_result = []
-        while poll_result == []:
+        # Retrying is needed in case the scheduler is slow updating
+        # its database which could make the result of ``client.job_info``
+        # to be an empty list or a "job not found" error
+        deadline = time.monotonic() + self.poll_time_budget
+        delay = self.poll_retry_delay
+        job_not_found = False
+        for attempt in range(self.poll_max_retries + 1):
+            if attempt > 0:
+                POLL_RETRIES.labels(host=self.host).inc()
             try:
-                poll_result = await client.job_info(self.host, self.job_id)
+                with observe_request("job_info", self.host):
+                    poll_result = await client.job_info(self.host,
+                                                        self.job_id)
+                if poll_result != []:
+                    return poll_result
+
+                job_not_found = True
             except UnexpectedStatusException as e:
                 self.log.info(f"Polling job status fail: {e}")
-                await asyncio.sleep(1)
+                job_not_found = e.responses[-1].status_code == 404
+            except httpx.TransportError as e:
+                self.log.info(f"Polling job status fail: {e!r}")
+                job_not_found = False
+
+            remaining = deadline - time.monotonic()
+            if attempt == self.poll_max_retries or remaining <= 0:
+                break
+
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * self.poll_retry_backoff,
+                        self.poll_retry_max_delay)
 
-        return poll_result
+        self.log.warning(
+            f"Giving up polling job {self.job_id} after {attempt + 1} "
+            f"attempts: job {'not found' if job_not_found else 'unknown'}"
+        )
+        return [] if job_not_found else None
 
     async def _get_batch_script(self, **subvars):
         """Format batch script from vars"""
         # Could be overridden by subclasses, but mainly useful for testing
         return format_template(self.batch_script, **subvars)
 
+    def get_job_env(self) -> dict:
+        """Returns the environment of the single-user server"""
+        job_env = self.get_env()
+        job_env.pop("PATH", None)
+        return job_env
+
+    @staticmethod
+    def encode_job_env(job_env: dict) -> dict:
+        """Returns the environment to be passed to the job submission"""
+        job_env = dict(job_env)
+        # FIXME: These two variables may have quotes in their values.
+        # We encoded as base64 since quotes are not allowed
+        # in firecrest requests
+        # The job script must have a line to decode them.
+        for v in ("JUPYTERHUB_OAUTH_ACCESS_SCOPES", "JUPYTERHUB_OAUTH_SCOPES"):
+            job_env[v] = base64.b64encode(job_env[v].encode()).decode("utf-8")
+
+        return job_env
+
     async def submit_batch_script(self):
         """Submits the batch script that starts the notebook server job
 
@@ -397,16 +2588,9 @@ class FirecRESTSpawnerBase(Spawner):
         if hasattr(self, "user_options"):
             subvars.update(self.user_options)
 
-        job_env = self.get_env()
-        if "PATH" in job_env:
-            job_env.pop("PATH")
-
-        # FIXME: These two variables may have quotes in their values.
-        # We encoded as base64 since quotes are not allowed
-        # in firecrest requests
-        # The job script must have a line to decode them.
-        for v in ("JUPYTERHUB_OAUTH_ACCESS_SCOPES", "JUPYTERHUB_OAUTH_SCOPES"):
-            job_env[v] = base64.b64encode(job_env[v].encode()).decode("utf-8")
+        # environment of the server when it's started in a warm pool job
+        step_env = self.get_job_env()
+        job_env = self.encode_job_env(step_env)
 
         self.host = subvars["host"]
 
@@ -414,38 +2598,60 @@ class FirecRESTSpawnerBase(Spawner):
                                  for role in self.user.roles)
 
         client = await self.get_firecrest_client()
+        self.record_phase("token_acquired")
 
-        groups = await client.userinfo(self.host)
+        groups = await self.get_userinfo(self.host, client)
+        self.record_phase("userinfo_done")
         account_from_form = self.user_options.get("account")
         if not account_from_form or account_from_form == [""]:
             subvars["account"] = groups["group"]["name"]
 
+        pool = self.get_warm_pool(subvars)
+        if pool is not None:
+            if await self.start_in_warm_pool(pool, client, step_env):
+                self.record_phase("submitted")
+                if self.job_status_poller is not None:
+                    self.job_status_poller.register(self.job_id)
+                return
+
         script = await self._get_batch_script(**subvars)
+        self.record_phase("script_rendered")
         self.log.info("Spawner submitting job using firecREST")
         self.log.info(f"Spawner submitted script:\n{script}")
 
         try:
             self.log.info("firecREST: Submitting job")
-            self.job = await client.submit(
-                self.host,
-                script_str=script,
-                env_vars=job_env,
-                working_dir="/".join((self.workdir, self.user.name))
-            )
+            with observe_request("submit", self.host):
+                self.job = await client.submit(
+                    self.host,
+                    script_str=script,
+                    env_vars=job_env,
+                    working_dir="/".join((self.workdir, self.user.name))
+                )
             self.log.debug(f"[client.submit] {self.job}")
             self.job_id = f"{self.job['jobId']}"
+            self._submitted = time.monotonic()
+            self.record_phase("submitted")
             self.log.info(f"Job {self.job_id} submitted")
+            if self.job_status_poller is not None:
+                self.job_status_poller.register(self.job_id)
         # In case the connection to the firecrest server timesout
         # catch httpx.ConnectTimeout since httpx.ConnectTimeout
         # doesn't print anything when cought
         except httpx.ConnectTimeout:
             self.log.error(f"Job submission failed: httpx.ConnectTimeout")
+            SUBMISSION_FAILURES.labels(host=self.host,
+                                       reason="ConnectTimeout").inc()
             self.job_id = ""
         except PollingIterException:
             self.log.error(f"Job submission failed: PollingIterException")
+            SUBMISSION_FAILURES.labels(host=self.host,
+                                       reason="PollingIterException").inc()
             self.job_id = ""
         except Exception as e:
             self.log.error(f"Job submission failed: {e}")
+            SUBMISSION_FAILURES.labels(host=self.host,
+                                       reason=type(e).__name__).inc()
             self.job_id = ""
             return e
 
@@ -465,47 +2671,283 @@ class FirecRESTSpawnerBase(Spawner):
         try:
             poll_result = await self.firecrest_poll()
             self.log.debug(f"[client.poll] [query_job_status] {poll_result}")
-            state = poll_result[0]["status"]["state"]
-            nodelist = hostlist.expand_hostlist(poll_result[0]["nodes"])
-            # when PENDING nodelist is []
-            host = nodelist[0] if len(nodelist) > 0 else ""
-            # `job_status` must keep the format used in the original
-            # batchspawner since it will be later parsed with
-            # regular expressions
-            self.job_status = f"{state} {host}"
+            if poll_result is None:
+                # FirecREST or the scheduler are not answering
+                return JobStatus.UNKNOWN
+
+            if poll_result == []:
+                return JobStatus.NOTFOUND
+
+            self.job_state = JobState.from_job_info(poll_result[0])
+            self.job_status = self.job_state.job_status
+        except CircuitOpenError as e:
+            # keep the last known state until the service is back
+            self.log.debug(f"Not querying job status: {e}")
+            return JobStatus.UNKNOWN
         except Exception as e:
             self.log.debug(f"Failed querying job status: {e} \n\n\n")
             return JobStatus.NOTFOUND
 
         if self.state_isrunning():
+            self.update_job_metrics("running")
             return JobStatus.RUNNING
         elif self.state_ispending():
+            self.update_job_metrics("pending")
             return JobStatus.PENDING
         elif self.state_isunknown():
             return JobStatus.UNKNOWN
         else:
+            self.update_job_metrics(None)
             return JobStatus.NOTFOUND
 
+    def record_phase(self, phase: str) -> None:
+        """Record the time at which a phase of the spawn is first reached"""
+        if phase not in self.spawn_timeline:
+            self.spawn_timeline[phase] = time.time()
+
+    def spawn_timeline_offsets(self) -> dict:
+        """Returns the seconds from the start of the spawn to each phase"""
+        start = self.spawn_timeline.get("start")
+        if start is None:
+            return {}
+
+        return {phase: round(timestamp - start, 3)
+                for phase, timestamp in self.spawn_timeline.items()}
+
+    def record_server_report(self) -> None:
+        """Record the report of the single-user server, the last phase of
+        the spawn seen by the spawner, and log the timeline of the spawn"""
+        if ("start" not in self.spawn_timeline or
+                "server_reported" in self.spawn_timeline):
+            return
+
+        self.record_phase("server_reported")
+        self.log.info("Spawn timeline " + json.dumps({
+            "user": self.user.name,
+            "server": self.name,
+            "job_id": self.job_id,
+            "host": getattr(self, "host", self.req_host),
+            "phases": self.spawn_timeline_offsets(),
+        }))
+
+    def update_job_metrics(self, state: Optional[str]) -> None:
+        """Keep the jobs gauge in sync with the state of the job and
+        observe the time it waited in the queue when it starts running"""
+        previous = self._job_metrics_state
+        current = (self.host, state) if state else None
+        if current == previous:
+            return
+
+        if previous is not None:
+            JOBS.labels(host=previous[0], state=previous[1]).dec()
+        if current is not None:
+            JOBS.labels(host=self.host, state=state).inc()
+        self._job_metrics_state = current
+
+        if state == "running" and self._submitted is not None:
+            QUEUE_WAIT_SECONDS.labels(host=self.host).observe(
+                time.monotonic() - self._submitted
+            )
+            self._submitted = None
+
     async def cancel_batch_job(self) -> None:
         """Cancel the job running the notebooks sever"""
 
+        if self.job_id and self.job_id == self._cancelled_job_id:
+            self.log.info(f"Job {self.job_id} already cancelled")
+            return
+
         self.log.info(f"Cancelling job {self.job_id}")
+        await self._cancel_job(self.job_id, self.host, self.warm_pool_job)
+
+    def cancels_as_service_account(self, warm_pool_job: bool = False) -> bool:
+        """Return boolean indicating if the jobs are cancelled with the
+        service account instead of the user's credentials"""
         is_service_account = any(role.name == 'service-account'
                                  for role in self.user.roles)
-        if is_service_account:
+        # the allocations of the warm pool are owned by the service account
+        return is_service_account or warm_pool_job
+
+    async def _cancel_job(self, job_id: str, host: str,
+                          warm_pool_job: bool = False) -> None:
+        if self.cancels_as_service_account(warm_pool_job):
             client = await self.get_firecrest_client_service_account()
         else:
             client = await self.get_firecrest_client()
 
         self.log.info("firecREST: Canceling job")
-        cancel_result = await client.cancel_job(self.host, self.job_id)
+        with observe_request("cancel_job", host):
+            cancel_result = await client.cancel_job(host, job_id)
         self.log.debug(f"[client.cancel] {cancel_result}")
 
+    @classmethod
+    async def cancel_jobs(cls, spawners) -> list[dict]:
+        """Cancel the jobs of several spawners at once
+
+        The jobs are grouped by FireCREST URL, system and identity (the
+        user or the service account), so that each group shares a single
+        client. The jobs of a group are cancelled concurrently, with at most
+        ``bulk_cancel_concurrency`` requests in flight. A later ``stop`` of
+        the spawners doesn't cancel their jobs again.
+
+        Returns one dictionary per spawner with its ``user``, ``server``,
+        ``job_id``, ``host`` and ``status`` (``cancelled``, ``failed`` or
+        ``no_job``), plus the ``error`` if the cancellation failed.
+        """
+        results = []
+        groups = {}
+        for spawner in spawners:
+            host = getattr(spawner, "host", spawner.req_host)
+            result = {
+                "user": spawner.user.name,
+                "server": spawner.name,
+                "job_id": spawner.job_id,
+                "host": host,
+                "status": "no_job",
+            }
+            results.append(result)
+            if not spawner.job_id:
+                continue
+
+            service_account = spawner.cancels_as_service_account(
+                spawner.warm_pool_job
+            )
+            identity = None if service_account else spawner.user.name
+            key = (spawner.firecrest_url, host, identity)
+            groups.setdefault(key, []).append((spawner, result))
+
+        async def cancel_group(group):
+            spawner = group[0][0]
+            if spawner.cancels_as_service_account(spawner.warm_pool_job):
+                get_client = spawner.get_firecrest_client_service_account
+            else:
+                get_client = spawner.get_firecrest_client
+
+            semaphore = asyncio.Semaphore(spawner.bulk_cancel_concurrency)
+            try:
+                client = await get_client()
+            except Exception as e:
+                for _, result in group:
+                    result.update(status="failed", error=str(e))
+                return
+
+            async def cancel(spawner, result):
+                async with semaphore:
+                    try:
+                        with observe_request("cancel_job", result["host"]):
+                            await client.cancel_job(result["host"],
+                                                    result["job_id"])
+                    except Exception as e:
+                        spawner.log.warning(
+                            f"Cancelling job {result['job_id']} fail: {e}"
+                        )
+                        result.update(status="failed", error=str(e))
+                    else:
+                        spawner._cancelled_job_id = result["job_id"]
+                        result["status"] = "cancelled"
+
+            await asyncio.gather(*(cancel(*item) for item in group))
+
+        await asyncio.gather(*(cancel_group(group)
+                               for group in groups.values()))
+        return results
+
+    async def job_is_alive(self, job_id: str, host: str,
+                           warm_pool_job: bool = False) -> Optional[bool]:
+        """Return boolean indicating if a job is still pending or running,
+        or ``None`` if its state couldn't be obtained
+
+        The job is requested individually with the cached client, since
+        the poller stops tracking the job when the state of the spawner is
+        cleared. An empty answer means that its state is unknown.
+        """
+        try:
+            if self.polling_with_service_account or warm_pool_job:
+                client = await self.get_firecrest_client_service_account()
+            else:
+                client = await self.get_firecrest_client()
+
+            with observe_request("job_info", host):
+                poll_result = await client.job_info(host, job_id)
+        except UnexpectedStatusException as e:
+            if e.responses[-1].status_code == 404:
+                return False
+
+            self.log.info(f"Checking job {job_id} fail: {e}")
+            return None
+        except Exception as e:
+            self.log.info(f"Checking job {job_id} fail: {e!r}")
+            return None
+
+        if not poll_result:
+            return None
+
+        return any(not JobState.from_job_info(job).is_finished
+                   for job in poll_result)
+
+    async def confirm_stop(self, job_id: str, host: str,
+                           warm_pool_job: bool = False) -> bool:
+        """Wait until a cancelled job is gone
+
+        The job is checked with exponential backoff. If it's still there
+        after ``stop_confirm_timeout`` seconds, it's cancelled again up to
+        ``stop_cancel_retries`` times before logging an error and counting
+        it in the ``stop_failures`` metric.
+
+        Returns whether the job is gone.
+        """
+        for attempt in range(self.stop_cancel_retries + 1):
+            if attempt > 0:
+                self.log.warning(f"Notebook server job {job_id} is still "
+                                 "running, cancelling it again")
+                try:
+                    await self._cancel_job(job_id, host, warm_pool_job)
+                except Exception as e:
+                    self.log.warning(f"Cancelling job {job_id} fail: {e}")
+
+            deadline = time.monotonic() + self.stop_confirm_timeout
+            delay = self.stop_confirm_delay
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                await asyncio.sleep(min(delay, remaining))
+                if await self.job_is_alive(job_id, host,
+                                           warm_pool_job) is False:
+                    self.log.debug(f"Notebook server job {job_id} is gone")
+                    return True
+
+                delay = min(delay * 2, self.stop_confirm_max_delay)
+
+        STOP_FAILURES.labels(host=host).inc()
+        self.log.error(
+            f"Notebook server job {job_id} possibly failed to terminate "
+            f"after {self.stop_cancel_retries + 1} cancellations"
+        )
+        return False
+
     def load_state(self, state) -> None:
         """Load ``job_id`` from state"""
         super(FirecRESTSpawnerBase, self).load_state(state)
         self.job_id = state.get("job_id", "")
         self.job_status = state.get("job_status", "")
+        self.warm_pool_job = state.get("warm_pool_job", False)
+        if self.warm_pool_job and self.job_id:
+            # the allocation mustn't be cancelled as a leftover of the pool
+            WarmPool.hand_over(self.job_id)
+        self.spawn_timeline = state.get("spawn_timeline", {})
+        if self.job_id:
+            # verify all the restored jobs with one listing per host
+            if self.job_status_poller is not None:
+                self.job_status_poller.reconcile(self.job_id, self.log)
+
+            # spread the checks of the credentials of the servers restored
+            # when the hub starts instead of doing them all at once
+            self._access_token_checked = (
+                time.monotonic() - self.access_token_check_interval
+                + random.uniform(0, self.startup_access_token_check_spread)
+            )
 
     def get_state(self) -> None:
         """Add ``job_id`` to state"""
@@ -514,13 +2956,27 @@ class FirecRESTSpawnerBase(Spawner):
             state["job_id"] = self.job_id
         if self.job_status:
             state["job_status"] = self.job_status
+        if self.warm_pool_job:
+            state["warm_pool_job"] = True
+        if self.spawn_timeline:
+            state["spawn_timeline"] = self.spawn_timeline
         return state
 
     def clear_state(self) -> None:
         """Clear ``job_id`` state"""
         super(FirecRESTSpawnerBase, self).clear_state()
+        if self.job_id and self.job_status_poller is not None:
+            self.job_status_poller.unregister(self.job_id)
+        if self.warm_pool_job:
+            WarmPool.release(self.job_id)
         self.job_id = ""
         self.job_status = ""
+        self.job_state = None
+        self.warm_pool_job = False
+        self._cancelled_job_id = None
+        self.update_job_metrics(None)
+        self._submitted = None
+        self.reset_node()
 
     def state_ispending(self) -> bool:
         """Return boolean indicating if job is still waiting to run,
@@ -542,33 +2998,60 @@ class FirecRESTSpawnerBase(Spawner):
         likely by parsing self.job_status"""
         raise NotImplementedError("Subclass must provide implementation")
 
-    async def poll(self) -> Optional[int]:
-        """Poll the process"""
+    async def check_access_token(self) -> bool:
+        """Check if the user's credentials are still valid and set
+        ``access_token_is_valid``.
 
-        # check if the refresh token is valid when
-        # accessing /hub/home and set `self.access_token_is_valid`
-        # for the template in `home.html`
-        stack = inspect.stack()
-        caller_frame = stack[3]
-        if "self" in caller_frame.frame.f_locals:
-            class_name = caller_frame.frame.f_locals["self"].__class__.__name__
+        The check doesn't contact the authorization server (see
+        ``AuthorizationCodeFlowAuth.has_valid_credentials``), so polling
+        the servers doesn't keep the users' sessions alive. If the validity
+        of the credentials is unknown, the previous value is kept. The
+        result is reused for ``access_token_check_interval`` seconds.
+        """
+        now = time.monotonic()
+        if (self._access_token_checked is not None and
+                now - self._access_token_checked < self.access_token_check_interval):
+            return self.access_token_is_valid
 
-            if class_name == "HomeHandler":
-                auth_state = await self.user.get_auth_state()
+        self._access_token_checked = now
+        try:
+            auth = await self.get_authorization()
+            is_valid = auth.has_valid_credentials()
+        except HTTPError:
+            self.log.info("Credentials expired.")
+            is_valid = False
+
+        if is_valid is not None:
+            self.access_token_is_valid = is_valid
+
+        return self.access_token_is_valid
+
+    def start_event_loop_monitor(self) -> None:
+        """Start the monitor of the event loop if it's enabled"""
+        if self.event_loop_monitor:
+            EventLoopMonitor.ensure_started(
+                interval=self.event_loop_monitor_interval,
+                threshold=self.event_loop_lag_threshold,
+                log=self.log,
+            )
 
-                try:
-                    auth = AuthorizationCodeFlowAuth(
-                        client_id=self.user.authenticator.client_id,
-                        client_secret=self.user.authenticator.client_secret,
-                        refresh_token=auth_state["refresh_token"],
-                        token_url=self.user.authenticator.token_url,
-                    )
-                    self.access_token_is_valid = bool(auth.get_access_token())
-                except HTTPError:
-                    self.log.info("Credentials expired.")
-                    self.access_token_is_valid = False
+    async def poll(self) -> Optional[int]:
+        """Poll the process"""
+        self.start_event_loop_monitor()
+
+        if self.warm_pool_size > 0:
+            WarmPool.reconcile(
+                self.firecrest_url,
+                getattr(self, "host", self.req_host),
+                self.get_firecrest_client_service_account,
+                self.warm_pool_job_name,
+                self.log,
+            )
+            WarmPool.maintain_all()
 
         status = await self.query_job_status()
+        # set `self.access_token_is_valid` for the template in `home.html`
+        await self.check_access_token()
         if status in (JobStatus.PENDING, JobStatus.RUNNING, JobStatus.UNKNOWN):
             return None
         else:
@@ -579,6 +3062,70 @@ class FirecRESTSpawnerBase(Spawner):
         0.5, help="Polling interval to check job state during startup"
     ).tag(config=True)
 
+    startup_poll_fast_duration = Float(
+        10,
+        help="Seconds after the job submission during which the job state "
+        "is polled every ``startup_poll_interval`` seconds. After that, the "
+        "polling interval grows exponentially while the job is pending.",
+    ).tag(config=True)
+
+    startup_poll_backoff = Float(
+        2,
+        help="Factor by which the polling interval grows while the job "
+        "is pending",
+    ).tag(config=True)
+
+    startup_poll_max_interval = Float(
+        30,
+        help="Maximum polling interval to check job state during startup",
+    ).tag(config=True)
+
+    startup_poll_jitter = Float(
+        0.2,
+        help="Fraction of the polling interval added or subtracted at random "
+        "to spread the requests of jobs submitted at the same time",
+    ).tag(config=True)
+
+    startup_poll_near_start = Float(
+        30,
+        help="If the scheduler expects the job to start within this number "
+        "of seconds, or the job is being configured, the job state is polled "
+        "every ``startup_poll_interval`` seconds again",
+    ).tag(config=True)
+
+    def job_starting_soon(self) -> bool:
+        """Return boolean indicating if the scheduler reports that the job
+        is about to start"""
+        if self.job_state is None:
+            return False
+
+        if self.job_state.state == SlurmJobState.CONFIGURING:
+            return True
+
+        start_time = self.job_state.start_time
+        return bool(
+            start_time and
+            start_time - time.time() < self.startup_poll_near_start
+        )
+
+    def startup_poll_delay(self, elapsed: float, previous_delay: float) -> float:
+        """Returns the time to wait before polling again the job state
+        during startup.
+
+        :param elapsed: seconds since the job submission
+        :param previous_delay: the value returned by the previous call, without
+                               jitter
+        """
+        if elapsed < self.startup_poll_fast_duration or self.job_starting_soon():
+            return self.startup_poll_interval
+
+        return min(previous_delay * self.startup_poll_backoff,
+                   self.startup_poll_max_interval)
+
+    def _jitter(self, delay: float) -> float:
+        jitter = self.startup_poll_jitter
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
     async def start(self) -> tuple[str, int]:
         """Start the process"""
         self.ip = self.traits()["ip"].default_value
@@ -588,6 +3135,10 @@ class FirecRESTSpawnerBase(Spawner):
         if self.server:
             self.server.port = self.port
 
+        self.start_event_loop_monitor()
+        self.reset_node()
+        self.spawn_timeline = {}
+        self.record_phase("start")
         ret = await self.submit_batch_script()
 
         # We are called with a timeout, and if the timeout expires, this
@@ -596,6 +3147,9 @@ class FirecRESTSpawnerBase(Spawner):
         # So this function should not return unless successful, and if
         # unsuccessful should either raise and Exception or loop forever.
         if len(self.job_id) == 0:
+            if isinstance(ret, CircuitOpenError):
+                raise ret
+
             message = "Jupyter batch job submission failure"
             try:
                 if ret.responses[-1].status_code in [200, 500]:
@@ -607,11 +3161,23 @@ class FirecRESTSpawnerBase(Spawner):
                 self.log.info(f"Could not extract detailed error message: {e}")
 
             raise RuntimeError(message)
+
+        # The single-user server reports its node when it starts. Polling
+        # the job is kept as a fallback, e.g. for older versions of
+        # ``firecrestspawner-singleuser``
+        submitted = time.monotonic()
+        delay = self.startup_poll_interval
         while True:
+            if self.callback_host():
+                self.record_phase("running")
+                break
+
             status = await self.query_job_status()
             if status == JobStatus.RUNNING:
+                self.record_phase("running")
                 break
             elif status == JobStatus.PENDING:
+                self.record_phase("pending")
                 self.log.debug(f"Job {self.job_id} still pending")
             elif status == JobStatus.UNKNOWN:
                 self.log.debug(f"Job {self.job_id} still unknown")
@@ -626,9 +3192,11 @@ class FirecRESTSpawnerBase(Spawner):
                     " while pending in the queue or died "
                     " immediately after starting."
                 )
-            await asyncio.sleep(self.startup_poll_interval)
+            delay = self.startup_poll_delay(time.monotonic() - submitted, delay)
+            await self.wait_for_node(self._jitter(delay))
 
-        self.ip = await self.state_gethost()
+        self.ip = self.callback_host() or await self.state_gethost()
+        self.record_phase("host_resolved")
 
         self.db.commit()
         self.log.info(
@@ -641,23 +3209,21 @@ class FirecRESTSpawnerBase(Spawner):
     async def stop(self, now: str = False) -> None:
         """Stop the singleuser server job.
 
-        Returns immediately after sending job cancellation command if now=True,
-        otherwise tries to confirm that job is no longer running."""
+        Returns as soon as the job cancellation is accepted. Unless
+        now=True, a background task then confirms that the job is no longer
+        running (see ``confirm_stop``)."""
 
         self.log.info("Stopping server job " + self.job_id)
         await self.cancel_batch_job()
-        if now:
+        if now or not self.job_id:
             return
-        for i in range(10):
-            status = await self.query_job_status()
-            if status not in (JobStatus.RUNNING, JobStatus.UNKNOWN):
-                return
-            await asyncio.sleep(1.0)
-        if self.job_id:
-            self.log.warning(
-                f"Notebook server job {self.job_id} at {self.ip}:{self.port} "
-                f"possibly failed to terminate"
-            )
+
+        # the state of the spawner is cleared once it's stopped
+        task = asyncio.ensure_future(
+            self.confirm_stop(self.job_id, self.host, self.warm_pool_job)
+        )
+        self._stop_confirmations.add(task)
+        task.add_done_callback(self._stop_confirmations.discard)
 
     @async_generator
     async def progress(self) -> AsyncGenerator[dict[str, str], None]:
@@ -680,45 +3246,52 @@ class FirecRESTSpawnerBase(Spawner):
             message.
 
         Note:
-            This generator pauses for one second between each status check to
-            avoid excessive polling.
+            The job state is the one obtained by the polling done in
+            ``start()``, so this generator doesn't make requests to FirecREST
+            until the job is running. A message is only yielded when it
+            changes.
         """
-        client = await self.get_firecrest_client()
+        message = None
         while True:
             if self.state_ispending():
-                try:
-                    poll_result = await client.job_info(self.host, self.job["jobId"])
-                    if poll_result[0]["state"] != "RUNNING":
-                        reason = poll_result[0]["nodes"]
-                        message = f"Job {self.job['jobId']} is pending in queue {reason} "
-                    else:
-                        message = f"Job {self.job['jobId']} is being allocated"
-
-                except:
-                    message = f"Job {self.job['jobId']} is pending in queue "
+                job_state = self.job_state
+                if job_state and job_state.state == SlurmJobState.CONFIGURING:
+                    new_message = f"Job {self.job_id} is being allocated"
+                else:
+                    new_message = f"Job {self.job_id} is pending in queue "
+                    if job_state and job_state.reason:
+                        new_message += f"({job_state.reason}) "
 
-                await yield_(
-                    {
-                        "message": message,
-                    }
-                )
             elif self.state_isrunning():
-                poll_result = await client.job_metadata(self.host, self.job["jobId"])
-                await yield_(
-                    {
-                        "message": "Cluster job running... waiting to connect. "
-                                   "If the server fails to start in a few moments, "
-                                   "check the log file for possible reasons: "
-                                   f"{poll_result[0]['standardOutput']}",
-                    }
-                )
+                message = "Cluster job running... waiting to connect."
+                try:
+                    client = await self.get_firecrest_client()
+                    with observe_request("job_metadata", self.host):
+                        poll_result = await client.job_metadata(self.host,
+                                                                self.job_id)
+                    message += (
+                        " If the server fails to start in a few moments, "
+                        "check the log file for possible reasons: "
+                        f"{poll_result[0]['standardOutput']}"
+                    )
+                except CircuitOpenError as e:
+                    self.log.debug(f"Not requesting the job metadata: {e}")
+
+                await yield_({"message": message,
+                              "timeline": self.spawn_timeline_offsets()})
                 return
             else:
+                new_message = "Waiting for job status..."
+
+            if new_message != message:
+                message = new_message
                 await yield_(
                     {
-                        "message": "Waiting for job status...",
+                        "message": message,
+                        "timeline": self.spawn_timeline_offsets(),
                     }
                 )
+
             await asyncio.sleep(1)
 
 
@@ -780,28 +3353,29 @@ class FirecRESTSpawnerRegexStates(FirecRESTSpawnerBase):
 
     def state_ispending(self) -> bool:
         assert self.state_pending_re, "Misconfigured: define state_running_re"
-        return self.job_status and re.search(self.state_pending_re, self.job_status)
+        return self.job_status and compile_regex(self.state_pending_re).search(self.job_status)
 
     def state_isrunning(self) -> bool:
         assert self.state_running_re, "Misconfigured: define state_running_re"
-        return self.job_status and re.search(self.state_running_re, self.job_status)
+        return self.job_status and compile_regex(self.state_running_re).search(self.job_status)
 
     def state_isunknown(self) -> Optional[bool]:
         # Blank means "not set" and this function always returns None.
         if self.state_unknown_re:
-            return self.job_status and re.search(self.state_unknown_re, self.job_status)
+            return self.job_status and compile_regex(self.state_unknown_re).search(self.job_status)
 
     async def state_gethost(self) -> str:
         if self.custom_state_gethost:
             return await self.custom_state_gethost(self)
 
-        poll_result = await self.firecrest_poll()
-        self.log.debug(f"[client.poll] [state_gethost] {poll_result}")
-
         # this function is called only when the job has been allocated,
-        # then ``nodelist`` won't be ``[]``
-        host = hostlist.expand_hostlist(poll_result[0]["nodes"])[0]
-        return self.node_name_template.format(host)
+        # so the state obtained while polling the job already has the nodes
+        if self.job_state is None or not self.job_state.host:
+            poll_result = await self.firecrest_poll()
+            self.log.debug(f"[client.poll] [state_gethost] {poll_result}")
+            self.job_state = JobState.from_job_info(poll_result[0])
+
+        return self.node_name_template.format(self.job_state.host)
 
 
 class SlurmSpawner(FirecRESTSpawnerRegexStates):
@@ -843,6 +3417,24 @@ echo "jupyterhub-singleuser ended gracefully"
 """
     ).tag(config=True)
 
+    warm_pool_batch_script = Unicode(
+        """#!/bin/bash
+#SBATCH --job-name={{job_name}}
+{% if partition  %}#SBATCH --partition={{partition}}{% endif %}
+{% if account    %}#SBATCH --account={{account}}{% endif %}
+{% if runtime    %}#SBATCH --time={{runtime}}{% endif %}
+{% if memory     %}#SBATCH --mem={{memory}}{% endif %}
+{% if gres       %}#SBATCH --gres={{gres}}{% endif %}
+{% if nprocs     %}#SBATCH --cpus-per-task={{nprocs}}{% endif %}
+{% if nnodes     %}#SBATCH --nodes={{nnodes}}{% endif %}
+{% if reservation%}#SBATCH --reservation={{reservation}}{% endif %}
+{% if constraint %}#SBATCH --constraint={{constraint}}{% endif %}
+{% if options    %}#SBATCH {{options}}{% endif %}
+
+sleep infinity
+"""
+    ).tag(config=True)
+
     # all these req_foo traits will be available as substvars
     # for templated strings
     req_cluster = Unicode(
@@ -900,3 +3492,20 @@ echo "jupyterhub-singleuser ended gracefully"
         r"^slurm_load_jobs error: (?:Socket timed out on send/recv|Unable to contact slurm controller)"
     ).tag(config=True)
     state_exechost_re = Unicode(r"\s+((?:[\w_-]+\.?)+)$").tag(config=True)
+
+
+def check_spawner_config(config, spawner_class=SlurmSpawner) -> None:
+    """Validate the configuration of a spawner class when the hub starts
+
+    JupyterHub doesn't check the configuration of the spawners at startup,
+    so errors like a syntax error in the ``batch_script`` template would
+    otherwise show up on the first spawn. Call it at the end of
+    ``jupyterhub_config.py`` to make the hub fail to start instead::
+
+        from firecrestspawner.spawner import check_spawner_config
+
+        check_spawner_config(c, SlurmSpawner)
+
+    Raises ``TraitError`` if a configured value isn't valid.
+    """
+    spawner_class(config=config)
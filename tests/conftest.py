@@ -0,0 +1,72 @@
+import pytest
+
+from context import (
+    AuthorizationCodeFlowAuth,
+    CircuitBreaker,
+    FirecrestClientRegistry,
+    JobStatusPoller,
+    RateLimiter,
+    SlurmSpawner,
+    UserInfoCache,
+    WarmPool
+)
+from jupyterhub.tests.conftest import db
+from jupyterhub.user import User
+from jupyterhub.objects import Hub
+from jupyterhub.utils import random_port
+from jupyterhub import orm
+from oauthenticator.generic import GenericOAuthenticator
+
+
+testport = random_port()
+
+
+@pytest.fixture(autouse=True)
+def clear_shared_state():
+    """Make sure that objects shared among spawners don't leak
+    between tests"""
+    yield
+    AuthorizationCodeFlowAuth.clear()
+    CircuitBreaker.clear()
+    FirecrestClientRegistry.clear()
+    JobStatusPoller.clear()
+    RateLimiter.clear()
+    UserInfoCache.clear()
+    WarmPool.clear()
+
+
+async def get_auth_state():
+    """Function to monkey patch `user.authenticator.get_auth_state`
+    to simulate a hub where the user is already logged in
+    """
+    auth_state = {
+        "access_token": "VALID_ACCESS_TOKEN",
+        "refresh_token": "VALID_REFRESH_TOKEN"
+    }
+    return auth_state
+
+
+def new_spawner(db, spawner_class=SlurmSpawner, user_name=None, **kwargs):
+    hub = Hub()
+    if user_name is None:
+        user = db.query(orm.User).first()
+    else:
+        user = orm.User.find(db, user_name)
+    user = User(user, {"authenticator": GenericOAuthenticator()})
+    # Monkey patch the `get_auth_state` function to return an
+    # auth state containing accesss tokens without having login
+    user.get_auth_state = get_auth_state
+    user.authenticator.client_id = "client-id"
+    user.authenticator.client_secret = "client-secret"
+    _spawner = user._new_spawner(
+        "",
+        spawner_class=spawner_class,
+        hub=hub,
+        user=user,
+        req_srun="",
+        req_host="cluster1",
+        port=testport,
+        node_name_template="{}.cluster1.ch",
+        polling_with_service_account=False,
+    )
+    return _spawner
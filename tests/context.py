@@ -7,7 +7,25 @@ os.environ["FIRECREST_URL"] = "https://firecrest-url-pytest.com"
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from firecrestspawner.spawner import (
+    AsyncAuthFirecrest,
+    AsyncClientCredentialsAuth,
     AuthorizationCodeFlowAuth,
+    CircuitBreaker,
+    check_spawner_config,
+    CircuitOpenError,
+    compile_template,
+    FirecrestClientRegistry,
+    first_hosts,
     format_template,
-    SlurmSpawner
+    get_node_ip_from_output,
+    iter_hostlist,
+    JobState,
+    JobStatus,
+    JobStatusPoller,
+    parse_node_ip,
+    RateLimiter,
+    SlurmJobState,
+    SlurmSpawner,
+    UserInfoCache,
+    WarmPool
 )
@@ -0,0 +1,114 @@
+import asyncio
+import hostlist
+import pytest
+
+from context import (
+    first_hosts,
+    format_template,
+    JobState,
+    SlurmSpawner
+)
+from handlers import auth_server, fc_server, read_json_file
+from conftest import new_spawner
+
+
+pytest.importorskip("pytest_benchmark")
+
+# The baseline is stored in ``benchmarks/``. To compare with it:
+#
+#   pytest test_benchmarks.py --benchmark-only \
+#       --benchmark-storage=file://benchmarks --benchmark-compare=0001 \
+#       --benchmark-compare-fail=min:50%
+#
+# and to store a new one after an intended change, replace
+# ``--benchmark-compare...`` with ``--benchmark-save=baseline``
+
+
+LARGE_NODELIST = "nid[000001-009000,009100-019999],login[01-10]"
+
+
+@pytest.fixture
+def event_loop_runner():
+    """Run coroutines in the same event loop across benchmark rounds,
+    so that the objects shared among spawners are reused"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def spawner(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.host = "cluster1"
+    spawner.job_id = "26"
+    spawner.api_token = "api-token"
+    spawner.oauth_client_id = "jupyterhub-user-user1"
+    return spawner
+
+
+def test_benchmark_format_template(benchmark, spawner):
+    subvars = spawner.get_req_subvars()
+    subvars["cmd"] = spawner.cmd_formatted_for_batch()
+    script = benchmark(format_template, SlurmSpawner.batch_script.default(),
+                       **subvars)
+    assert "jupyterhub-singleuser" in script
+
+
+def test_benchmark_get_req_subvars(benchmark, spawner):
+    subvars = benchmark(spawner.get_req_subvars)
+    assert subvars["host"] == "cluster1"
+
+
+def test_benchmark_job_env(benchmark, spawner):
+    def prepare_job_env():
+        return spawner.encode_job_env(spawner.get_job_env())
+
+    job_env = benchmark(prepare_job_env)
+    assert "PATH" not in job_env
+    assert "JUPYTERHUB_OAUTH_SCOPES" in job_env
+
+
+def test_benchmark_job_state(benchmark):
+    job_info = read_json_file("responses/26.json")["response"]["jobs"][0]
+    job_state = benchmark(JobState.from_job_info, job_info)
+    assert job_state.job_status == "RUNNING localhost"
+
+
+def test_benchmark_state_regexes(benchmark, spawner):
+    spawner.job_status = "PENDING None assigned"
+
+    def check_states():
+        return (bool(spawner.state_isrunning()),
+                bool(spawner.state_ispending()),
+                bool(spawner.state_isunknown()))
+
+    assert benchmark(check_states) == (False, True, False)
+
+
+def test_benchmark_query_job_status(benchmark, spawner, event_loop_runner):
+    status = benchmark(lambda: event_loop_runner(spawner.query_job_status()))
+    assert status.name == "RUNNING"
+
+
+def test_benchmark_poll(benchmark, spawner, event_loop_runner):
+    assert benchmark(lambda: event_loop_runner(spawner.poll())) is None
+
+
+def test_benchmark_expand_hostlist_large(benchmark):
+    hosts = benchmark(hostlist.expand_hostlist, LARGE_NODELIST)
+    assert hosts[0] == "nid000001"
+
+
+def test_benchmark_first_hosts_large(benchmark):
+    hosts = benchmark(first_hosts, LARGE_NODELIST)
+    assert hosts == ["nid000001"]
+
+
+def test_benchmark_first_hosts_single_node(benchmark):
+    hosts = benchmark(first_hosts, "nid000001")
+    assert hosts == ["nid000001"]
@@ -13,61 +13,57 @@ from handlers import (fc_server,
                       submit_handler)
 
 
+import asyncio
+import base64
+import hostlist
+import httpx
 import json
+import logging
 import re
+import requests
+import socket
+import time
 import firecrest
 import getpass
 import pytest
+from prometheus_client import REGISTRY
 from werkzeug.wrappers import Response
+from firecrestspawner.api import (apply_spawner_updates,
+                                  FireCRESTSpawnerCancelAPIHandler)
+from firecrestspawner.loopmonitor import (BlockingCallError,
+                                          EventLoopMonitor,
+                                          fail_on_blocking)
+from firecrestspawner.singleuser import get_node_ip, report_to_hub
 from context import (
+    AsyncAuthFirecrest,
+    AsyncClientCredentialsAuth,
     AuthorizationCodeFlowAuth,
+    CircuitBreaker,
+    check_spawner_config,
+    CircuitOpenError,
+    compile_template,
+    FirecrestClientRegistry,
+    first_hosts,
     format_template,
-    SlurmSpawner
+    get_node_ip_from_output,
+    iter_hostlist,
+    JobState,
+    JobStatus,
+    JobStatusPoller,
+    parse_node_ip,
+    RateLimiter,
+    SlurmJobState,
+    SlurmSpawner,
+    UserInfoCache,
+    WarmPool
 )
-from jupyterhub.tests.conftest import db
-from jupyterhub.user import User
-from jupyterhub.objects import Hub
-from jupyterhub.utils import random_port
+from conftest import new_spawner, testport
 from jupyterhub import orm
-from oauthenticator.generic import GenericOAuthenticator
-
-
-testport = random_port()
-
-
-async def get_auth_state():
-    """Function to monkey patch `user.authenticator.get_auth_state`
-    to simulate a hub where the user is already logged in
-    """
-    auth_state = {
-        "access_token": "VALID_ACCESS_TOKEN",
-        "refresh_token": "VALID_REFRESH_TOKEN"
-    }
-    return auth_state
-
-
-def new_spawner(db, spawner_class=SlurmSpawner, **kwargs):
-    hub = Hub()
-    user = db.query(orm.User).first()
-    user = User(user, {"authenticator": GenericOAuthenticator()})
-    # Monkey patch the `get_auth_state` function to return an
-    # auth state containing accesss tokens without having login
-    user.get_auth_state = get_auth_state
-    user.authenticator.client_id = "client-id"
-    user.authenticator.client_secret = "client-secret"
-    _spawner = user._new_spawner(
-        "",
-        spawner_class=spawner_class,
-        hub=hub,
-        user=user,
-        req_srun="",
-        req_host="cluster1",
-        port=testport,
-        node_name_template="{}.cluster1.ch",
-        polling_with_service_account=False,
-    )
-    return _spawner
-
+from jupyterhub.scopes import parse_scopes
+from types import SimpleNamespace
+from tornado.web import HTTPError
+from traitlets import TraitError
+from traitlets.config import Config
 
 
 def test_format_template():
@@ -80,6 +76,33 @@ def test_format_template():
     assert templated == "value_1 and value_2"
 
 
+def test_compile_template():
+    template = "{{key_1}} and {{key_2}}"
+    assert compile_template(template) is compile_template(template)
+
+
+def test_batch_script_syntax_error(db):
+    spawner = new_spawner(db=db)
+    with pytest.raises(TraitError) as excinfo:
+        spawner.batch_script = "{% if partition %}#SBATCH {{partition}}"
+
+    assert "Invalid batch_script template" in str(excinfo.value)
+
+
+def test_check_spawner_config():
+    config = Config()
+    config.SlurmSpawner.batch_script = "#!/bin/bash\n{{cmd}}"
+    check_spawner_config(config)
+
+    config.Spawner.batch_script = "{% if partition %}#SBATCH {{partition}}"
+    check_spawner_config(config)  # overridden by the SlurmSpawner section
+    del config.SlurmSpawner["batch_script"]
+    with pytest.raises(TraitError) as excinfo:
+        check_spawner_config(config, SlurmSpawner)
+
+    assert "Invalid batch_script template" in str(excinfo.value)
+
+
 def test_get_access_token(db, fc_server, auth_server):
     spawner = new_spawner(db=db)
     spawner.firecrest_url = fc_server.url_for("/")
@@ -96,6 +119,42 @@ def test_get_access_token(db, fc_server, auth_server):
     assert auth.get_access_token() == "VALID_ACCESS_TOKEN"
 
 
+@pytest.mark.asyncio
+async def test_async_get_access_token(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    auth = AuthorizationCodeFlowAuth(
+        client_id=spawner.user.authenticator.client_id,
+        client_secret=spawner.user.authenticator.client_secret,
+        refresh_token="VALID_REFRESH_TOKEN",
+        token_url=spawner.user.authenticator.token_url
+    )
+    assert await auth.async_get_access_token() == "VALID_ACCESS_TOKEN"
+
+
+@pytest.mark.asyncio
+async def test_async_get_access_token_expired(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    auth = AuthorizationCodeFlowAuth(
+        client_id=spawner.user.authenticator.client_id,
+        client_secret=spawner.user.authenticator.client_secret,
+        refresh_token="EXPIRED_REFRESH_TOKEN",
+        token_url=spawner.user.authenticator.token_url
+    )
+    with pytest.raises(HTTPError) as excinfo:
+        await auth.async_get_access_token()
+
+    assert excinfo.value.status_code == 401
+    assert "log back in" in excinfo.value.html_message
+
+
 @pytest.mark.asyncio
 async def test_get_req_subvars(db):
     spawner = new_spawner(db=db)
@@ -128,6 +187,9 @@ async def test_get_req_subvars(db):
         "username": spawner.user.name,  # getpass.getuser(),
     }
     assert spawner.get_req_subvars() == expected_subvars
+    assert set(SlurmSpawner.req_trait_names()) == {
+        f"req_{key}" for key in expected_subvars
+    }
 
 
 @pytest.mark.asyncio
@@ -370,3 +432,1331 @@ async def test_start_job_fail(db, fc_server, auth_server):
         "immediately after starting."
     )
     assert spawner.job_status == ""  # `spawner.job_status` is cleared
+
+
+def count_requests(httpserver, path, method="GET"):
+    return len([req for req, _ in httpserver.log
+                if req.path == path and req.method == method])
+
+
+@pytest.mark.asyncio
+async def test_job_status_poller(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    poller = JobStatusPoller("cluster1", spawner.get_firecrest_client,
+                             interval=60)
+    poller.register("26")
+    poller.register("27")
+    job_26, job_27, job_352 = await asyncio.gather(
+        poller.job_info("26"),
+        poller.job_info("27"),
+        poller.job_info("352"),
+    )
+    assert job_26[0]["status"]["state"] == "RUNNING"
+    assert job_27[0]["status"]["state"] == "PENDING"
+    assert job_352 == []
+    # jobs from other users are not kept
+    assert set(poller.jobs) == {"26", "27"}
+    assert count_requests(fc_server, "/compute/cluster1/jobs") == 1
+
+    # the snapshot is reused within the interval
+    await poller.job_info("26")
+    assert count_requests(fc_server, "/compute/cluster1/jobs") == 1
+
+
+@pytest.mark.asyncio
+async def test_query_job_status_batch_polling(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.polling_with_service_account = True
+    spawner.batch_polling = True
+    # the test server only accepts the user's access token
+    spawner.get_firecrest_client_service_account = spawner.get_firecrest_client
+    spawner.host = "cluster1"
+    spawner.job_id = "26"
+    job_status = await spawner.query_job_status()
+    assert job_status.name == "RUNNING"
+    assert spawner.job_status == "RUNNING nid001"
+    assert count_requests(fc_server, "/compute/cluster1/jobs") == 1
+    assert count_requests(fc_server, "/compute/cluster1/jobs/26") == 0
+
+    # after a failed listing the job is polled individually for a while
+    poller = spawner.job_status_poller
+    poller.updated = None
+    poller.failed = time.monotonic()
+    assert await spawner.query_job_status() == JobStatus.RUNNING
+    assert count_requests(fc_server, "/compute/cluster1/jobs") == 1
+    assert count_requests(fc_server, "/compute/cluster1/jobs/26") == 1
+
+
+@pytest.mark.asyncio
+async def test_reconcile_restored_jobs(db, fc_server, auth_server):
+    spawners = []
+    for job_id in ("26", "27", "51"):
+        spawner = new_spawner(db=db)
+        spawner.firecrest_url = fc_server.url_for("/")
+        spawner.user.authenticator.token_url = "".join([
+            auth_server.url_for("/") ,
+            "auth/realms/kcrealm/protocol/openid-connect/token"
+        ])
+        spawner.polling_with_service_account = True
+        spawner.batch_polling = True
+        spawner.get_firecrest_client_service_account = (
+            spawner.get_firecrest_client
+        )
+        spawner.poll_retry_delay = 0.05
+        spawner.poll_time_budget = 0.1
+        spawner.load_state({"job_id": job_id})
+        spawners.append(spawner)
+
+    # restored servers aren't assumed to have valid credentials and
+    # their checks are spread in time
+    assert not any(spawner.access_token_is_valid for spawner in spawners)
+    assert all(spawner._access_token_checked is not None
+               for spawner in spawners)
+
+    results = await asyncio.gather(*[spawner.poll() for spawner in spawners])
+    assert results == [None, None, 1]
+    assert [spawner.job_status for spawner in spawners[:2]] == [
+        "RUNNING nid001", "PENDING None assigned"
+    ]
+    assert count_requests(fc_server, "/compute/cluster1/jobs") == 1
+    # the job missing from the listing is polled individually,
+    # the test server answers 404 for it
+    assert count_requests(fc_server, "/compute/cluster1/jobs/51") > 0
+    assert count_requests(
+        auth_server,
+        "/auth/realms/kcrealm/protocol/openid-connect/token",
+        method="POST"
+    ) == 1
+
+
+@pytest.mark.asyncio
+async def test_reconcile_listing_failure(caplog):
+    async def client_factory():
+        raise RuntimeError("FirecREST is unavailable")
+
+    log = logging.getLogger("test_reconcile_listing_failure")
+    poller = JobStatusPoller("cluster1", client_factory)
+    poller.reconcile("26", log)
+    with pytest.raises(RuntimeError):
+        await poller._listing
+
+    await asyncio.sleep(0)
+    assert "FirecREST is unavailable" in caplog.text
+    # the jobs are polled individually until the backoff expires
+    assert poller.is_backing_off()
+
+
+@pytest.mark.asyncio
+async def test_access_token_cache(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    clients = await asyncio.gather(
+        *[spawner.get_firecrest_client() for _ in range(5)]
+    )
+    await spawner.get_firecrest_client()
+    assert count_requests(
+        auth_server,
+        "/auth/realms/kcrealm/protocol/openid-connect/token",
+        method="POST"
+    ) == 1
+    auth = clients[0]._authorization
+    assert all(c._authorization is auth for c in clients)
+    assert auth.is_token_valid()
+
+
+@pytest.mark.asyncio
+async def test_access_token_rotated_refresh_token(db, httpserver):
+    def rotating_keycloak_handler(request):
+        return Response(
+            json.dumps({
+                "access_token": "VALID_ACCESS_TOKEN",
+                "expires_in": 300,
+                "refresh_token": "ROTATED_REFRESH_TOKEN",
+            }),
+            status=200,
+            content_type="application/json",
+        )
+
+    httpserver.expect_request(
+        "/auth/realms/kcrealm/protocol/openid-connect/token", method="POST"
+    ).respond_with_handler(rotating_keycloak_handler)
+
+    spawner = new_spawner(db=db)
+    spawner.user.authenticator.token_url = httpserver.url_for(
+        "/auth/realms/kcrealm/protocol/openid-connect/token"
+    )
+    saved_auth_states = []
+
+    async def save_auth_state(auth_state):
+        saved_auth_states.append(auth_state)
+
+    spawner.user.save_auth_state = save_auth_state
+    auth = await spawner.get_authorization()
+    assert await auth.async_get_access_token() == "VALID_ACCESS_TOKEN"
+    assert auth.refresh_token == "ROTATED_REFRESH_TOKEN"
+    assert saved_auth_states[0]["refresh_token"] == "ROTATED_REFRESH_TOKEN"
+
+    # an ``auth_state`` that still has the replaced token doesn't
+    # override the rotated one
+    auth = await spawner.get_authorization()
+    assert auth.refresh_token == "ROTATED_REFRESH_TOKEN"
+
+
+@pytest.mark.asyncio
+async def test_firecrest_client_registry(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.firecrest_max_connections = 4
+    client_1 = await spawner.get_firecrest_client()
+    client_2 = await spawner.get_firecrest_client()
+    assert client_1 is client_2
+    session = FirecrestClientRegistry.get_session()
+    assert client_1._session is session
+    assert session._transport._pool._max_connections == 4
+    # the token is refreshed using the same connection pool
+    assert client_1._authorization.http_client is session
+
+    FirecrestClientRegistry.evict_idle(idle_timeout=-1)
+    client_3 = await spawner.get_firecrest_client()
+    assert client_3 is not client_1
+    assert client_3._session is session
+
+
+def make_jwt(**claims) -> str:
+    """Unsigned JWT with the given claims"""
+    def encode(data):
+        return base64.urlsafe_b64encode(
+            json.dumps(data).encode()
+        ).decode().rstrip("=")
+
+    return f"{encode({'alg': 'none'})}.{encode(claims)}."
+
+
+@pytest.mark.asyncio
+async def test_check_access_token(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.host = "cluster1"
+    spawner.job_id = "26"
+    assert await spawner.poll() is None
+    assert spawner.access_token_is_valid
+
+    # the access token and the refresh token (`refresh_expires_in`)
+    # have expired
+    auth = await spawner.get_authorization()
+    auth.token_expiration_ts = time.time() - 1
+    auth.refresh_token_expiration_ts = time.time() - 1
+    token_path = "/auth/realms/kcrealm/protocol/openid-connect/token"
+    token_requests = count_requests(auth_server, token_path, "POST")
+
+    # the result is reused within `access_token_check_interval`
+    assert await spawner.check_access_token()
+
+    spawner.access_token_check_interval = 0
+    assert not await spawner.check_access_token()
+    assert not spawner.access_token_is_valid
+    # the authorization server isn't contacted
+    assert count_requests(auth_server, token_path, "POST") == token_requests
+
+    # the expiration of a JWT refresh token is taken from its claims
+    async def get_jwt_auth_state():
+        return {"refresh_token": make_jwt(exp=time.time() + 60)}
+
+    spawner.user.get_auth_state = get_jwt_auth_state
+    assert await spawner.check_access_token()
+
+    async def get_expired_jwt_auth_state():
+        return {"refresh_token": make_jwt(exp=time.time() - 60)}
+
+    spawner.user.get_auth_state = get_expired_jwt_auth_state
+    assert not await spawner.check_access_token()
+
+    # the previous value is kept if the expiration is unknown
+    async def get_opaque_auth_state():
+        return {"refresh_token": "OPAQUE_REFRESH_TOKEN"}
+
+    spawner.user.get_auth_state = get_opaque_auth_state
+    assert not await spawner.check_access_token()
+    assert count_requests(auth_server, token_path, "POST") == token_requests
+
+
+def test_startup_poll_delay(db):
+    spawner = new_spawner(db=db)
+    spawner.startup_poll_interval = 0.5
+    spawner.startup_poll_fast_duration = 10
+    spawner.startup_poll_backoff = 2
+    spawner.startup_poll_max_interval = 3
+    assert spawner.startup_poll_delay(1, 0.5) == 0.5
+    delays = [0.5]
+    for i in range(4):
+        delays.append(spawner.startup_poll_delay(20, delays[-1]))
+    assert delays == [0.5, 1, 2, 3, 3]
+
+    # back to fast polling when the job is about to start
+    spawner.job_state = JobState("1", "CONFIGURING")
+    assert spawner.startup_poll_delay(20, 3) == 0.5
+    spawner.job_state = JobState("1", "PENDING",
+                                 start_time=time.time() + 3600)
+    assert spawner.startup_poll_delay(20, 3) == 3
+    spawner.job_state.start_time = time.time() + 5
+    assert spawner.startup_poll_delay(20, 3) == 0.5
+
+
+@pytest.mark.asyncio
+async def test_firecrest_poll_unknown(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.poll_max_retries = 2
+    spawner.poll_retry_delay = 0.01
+    spawner.host = "cluster1"
+    # there's no response for this job in the test server,
+    # which answers with an error 500
+    spawner.job_id = "352"
+    assert await spawner.firecrest_poll() is None
+    job_status = await spawner.query_job_status()
+    assert job_status.name == "UNKNOWN"
+
+
+@pytest.mark.asyncio
+async def test_firecrest_poll_not_found(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.poll_max_retries = 10
+    spawner.poll_retry_delay = 0.05
+    spawner.poll_time_budget = 0.1
+    spawner.host = "cluster1"
+    # the test server answers 404 for this job
+    spawner.job_id = "51"
+    assert await spawner.firecrest_poll() == []
+    assert count_requests(fc_server, "/compute/cluster1/jobs/51") < 11
+    job_status = await spawner.query_job_status()
+    assert job_status.name == "NOTFOUND"
+
+
+def test_job_state():
+    data = read_json_file("responses/job_info.json")
+    job_state = JobState.from_job_info(data["response"]["jobs"][0])
+    assert job_state.job_id == "26"
+    assert job_state.state is SlurmJobState.RUNNING
+    assert job_state.nodes == "nid[001-002]"
+    assert job_state.reason == ""
+    assert job_state.start_time == 1756904609
+    assert job_state.end_time is None
+    assert job_state.host == "nid001"
+    assert job_state.job_status == "RUNNING nid001"
+    assert not job_state.is_finished
+    assert not hasattr(job_state, "__dict__")
+
+    # older versions of the API
+    data = read_json_file("responses/28.json")
+    job_state = JobState.from_job_info(data["response"]["jobs"][0])
+    assert job_state.state is SlurmJobState.FAILED
+    assert job_state.is_finished
+
+    # states unknown to the spawner are kept as they are reported
+    job_state = JobState.from_job_info({"jobId": 1, "status": {
+        "state": ["RUNNING", "COMPLETING"]
+    }})
+    assert job_state.state == "RUNNING,COMPLETING"
+    assert job_state.job_status == "RUNNING,COMPLETING "
+
+
+@pytest.mark.asyncio
+async def test_state_gethost(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.host = "cluster1"
+    spawner.job_id = "26"
+    job_status = await spawner.query_job_status()
+    assert job_status.name == "RUNNING"
+    assert await spawner.state_gethost() == "localhost.cluster1.ch"
+    # the host is taken from the state obtained by `query_job_status`
+    assert count_requests(fc_server, "/compute/cluster1/jobs/26") == 1
+
+
+@pytest.mark.parametrize("nodelist", [
+    "nid001",
+    "nid[001-003]",
+    "nid[01-3],login01",
+    "a[9-11]",
+    "x[001-003,7]y[1-2]",
+    "n[1-2]-ib,n1-ib",
+    "nid[001-002],nid[002-004]",
+])
+def test_iter_hostlist(nodelist):
+    assert list(iter_hostlist(nodelist)) == hostlist.expand_hostlist(nodelist)
+
+
+def test_first_hosts():
+    assert first_hosts("") == []
+    assert first_hosts("nid001") == ["nid001"]
+    assert first_hosts("nid[000001-999999]", 3) == [
+        "nid000001", "nid000002", "nid000003"
+    ]
+    assert first_hosts("nid[001-002],nid[002-004]", 3) == [
+        "nid001", "nid002", "nid003"
+    ]
+    with pytest.raises(ValueError):
+        first_hosts("nid[003-001]")
+
+
+@pytest.mark.asyncio
+async def test_start_node_reported(db):
+    spawner = new_spawner(db=db)
+    spawner.startup_poll_interval = 10
+    spawner.singleuser_callback_address = "hostname"
+
+    async def submit_batch_script():
+        spawner.host = "cluster1"
+        spawner.job_id = "26"
+
+    async def query_job_status():
+        return JobStatus.PENDING
+
+    async def report_node():
+        await asyncio.sleep(0.1)
+        # done by the API handler when the single-user server starts
+        spawner.node_ip = "10.0.0.1"
+        spawner.node_hostname = "nid001"
+
+    spawner.submit_batch_script = submit_batch_script
+    spawner.query_job_status = query_job_status
+    asyncio.ensure_future(report_node())
+    ip, port = await asyncio.wait_for(spawner.start(), 5)
+    assert ip == "nid001.cluster1.ch"
+    assert port == testport
+
+    spawner.singleuser_callback_address = "ip"
+    assert spawner.callback_host() == "10.0.0.1"
+
+    spawner.clear_state()
+    assert spawner.callback_host() == ""
+    assert not spawner.node_ready.is_set()
+
+    # a report without the address doesn't end the wait early
+    spawner.node_ready.set()
+    start = time.monotonic()
+    assert not await spawner.wait_for_node(0.2)
+    assert time.monotonic() - start >= 0.15
+
+
+@pytest.mark.parametrize("addresses,ip", [
+    (["127.0.1.1", "10.1.2.3"], "10.1.2.3"),
+    (["fe80::1%eth0", "2001:db8::1", "10.1.2.3"], "10.1.2.3"),
+    (["127.0.1.1", "::1", "2001:db8::1"], "2001:db8::1"),
+    (["127.0.1.1"], ""),
+])
+def test_get_node_ip(monkeypatch, addresses, ip):
+    def getaddrinfo(host, port):
+        return [(None, None, None, "", (address, 0)) for address in addresses]
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    assert get_node_ip("nid001") == ip
+
+
+@pytest.mark.parametrize("output,ip", [
+    ("10.1.2.3\n", "10.1.2.3"),
+    ("fe80::1%eth0 127.0.0.1 10.1.2.3 2001:db8::1\n", "10.1.2.3"),
+    ("2001:db8::1 fe80::1\nhello", "2001:db8::1"),
+    ("", ""),
+])
+def test_parse_node_ip(output, ip):
+    assert parse_node_ip(output) == ip
+
+
+@pytest.mark.asyncio
+async def test_get_node_ip_from_output(db, monkeypatch):
+    spawner = new_spawner(db=db)
+    spawner.host = "cluster1"
+    spawner.job_id = "26"
+    spawner.job = {"jobId": 26, "job_file_out": "/home/user/job.out"}
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+
+    class Client:
+        calls = 0
+
+        async def head(self, system_name, path, num_lines=None):
+            assert path == "/home/user/job.out"
+            self.calls += 1
+            if self.calls == 1:
+                raise httpx.ConnectError("connection refused")
+
+            if self.calls == 2:
+                return ""
+
+            return "fe80::1 10.1.2.3\n"
+
+    client = Client()
+    client_requests = []
+
+    async def get_firecrest_client():
+        client_requests.append(1)
+        return client
+
+    spawner.get_firecrest_client = get_firecrest_client
+    assert await get_node_ip_from_output(spawner) == "10.1.2.3"
+    assert client.calls == 3
+    assert len(client_requests) == 1
+    assert delays == [1, 2]
+
+    spawner.start_timeout = 0
+    client.calls = 0
+    with pytest.raises(TimeoutError):
+        await get_node_ip_from_output(spawner)
+
+
+@pytest.mark.asyncio
+async def test_userinfo_cache(db):
+    spawner = new_spawner(db=db)
+    requests = []
+
+    class Client:
+        async def userinfo(self, system_name):
+            requests.append(system_name)
+            await asyncio.sleep(0.01)
+            return {"group": {"name": "group1"}}
+
+    async def get_firecrest_client():
+        return Client()
+
+    spawner.get_firecrest_client = get_firecrest_client
+    await spawner.prefetch_userinfo()
+    userinfo = await asyncio.gather(
+        spawner.get_userinfo("cluster1"),
+        spawner.get_userinfo("cluster1"),
+    )
+    assert userinfo[0]["group"]["name"] == "group1"
+    assert requests == ["cluster1"]
+
+    await spawner.get_userinfo("cluster2")
+    assert requests == ["cluster1", "cluster2"]
+
+    spawner.userinfo_cache_ttl = 0
+    await spawner.get_userinfo("cluster1")
+    assert requests == ["cluster1", "cluster2", "cluster1"]
+
+
+@pytest.mark.asyncio
+async def test_warm_pool(db):
+    spawner = new_spawner(db=db)
+    spawner.host = "cluster1"
+    spawner.warm_pool_size = 1
+    spawner.warm_pool_refill_interval = 0
+
+    class Client:
+        def __init__(self):
+            self.jobs = {}
+            self.attached = []
+            self.cancelled = []
+            self.files = {}
+            self.modes = {}
+
+        async def submit(self, system_name, script_str, working_dir):
+            assert "sleep infinity" in script_str
+            assert "--job-name=spawner-jupyterhub-pool" in script_str
+            job_id = str(100 + len(self.jobs))
+            self.jobs[job_id] = "RUNNING"
+            return {"jobId": int(job_id)}
+
+        async def job_info(self, system_name):
+            return [{"jobId": int(job_id), "name": "spawner-jupyterhub-pool",
+                     "status": {"state": state}}
+                    for job_id, state in self.jobs.items()]
+
+        async def attach_to_job(self, system_name, jobid, command):
+            self.attached.append((jobid, command))
+
+        async def cancel_job(self, system_name, jobid):
+            self.cancelled.append(jobid)
+            self.jobs[jobid] = "CANCELLED"
+
+        async def mkdir(self, system_name, path, create_parents=False):
+            self.modes[path] = "755"
+
+        async def chmod(self, system_name, path, mode):
+            self.modes[path] = mode
+
+        async def upload(self, system_name, local_file, directory, filename):
+            # the file is only written in a private directory
+            assert self.modes[directory] == "700"
+            with open(local_file) as f:
+                self.files[f"{directory}/{filename}"] = f.read()
+
+    client = Client()
+
+    async def get_client():
+        return client
+
+    spawner.get_firecrest_client_service_account = get_client
+    subvars = {"host": "cluster1", "partition": "normal", "memory": "4G"}
+    pool = spawner.get_warm_pool(subvars)
+    assert pool is spawner.get_warm_pool(dict(subvars))
+    # the pools are kept per resource profile
+    assert pool is not spawner.get_warm_pool(dict(subvars, memory="8G"))
+    assert "--mem=4G" in pool.script
+
+    def acquisitions(outcome):
+        return REGISTRY.get_sample_value(
+            "firecrestspawner_warm_pool_acquisitions_total",
+            {"host": "cluster1", "outcome": outcome}
+        ) or 0
+
+    hits, misses = acquisitions("hit"), acquisitions("miss")
+
+    # the pool is empty: the job must be submitted
+    assert not await spawner.start_in_warm_pool(pool, client, {})
+    await pool._maintaining
+    assert list(pool.jobs) == ["100"]
+    assert REGISTRY.get_sample_value("firecrestspawner_warm_pool_jobs",
+                                     {"host": "cluster1"}) == 1
+
+    env = {"JUPYTERHUB_API_TOKEN": "token", "JUPYTERHUB_OAUTH_SCOPES": '["a"]',
+           "JUPYTERHUB_OAUTH_ACCESS_SCOPES": '["b"]'}
+    assert await spawner.start_in_warm_pool(pool, client, env)
+    assert spawner.job_id == "100"
+    assert spawner.get_state()["warm_pool_job"]
+    job_id, command = client.attached[0]
+    assert job_id == "100"
+    # the environment isn't in the step's command line
+    assert command == (f"/users/{spawner.user.name}/.firecrestspawner/"
+                       "launch-100.sh")
+    assert client.modes[command] == "700"
+    launcher = client.files[command]
+    assert "export JUPYTERHUB_API_TOKEN=token\n" in launcher
+    assert "JUPYTERHUB_OAUTH_SCOPES=WyJhIl0=" in launcher
+    assert launcher.endswith(f"exec {spawner.cmd_formatted_for_batch()}\n")
+    assert pool.hits == 1 and pool.misses == 1
+    assert pool.hit_rate == 0.5
+    assert acquisitions("hit") == hits + 1
+    assert acquisitions("miss") == misses + 1
+
+    await pool._maintaining
+    assert list(pool.jobs) == ["101"]
+    pool.idle_timeout = 0
+    pool.size = 0
+    pool.maintain()
+    await pool._maintaining
+    assert client.cancelled == ["101"]
+    assert pool.jobs == {}
+
+    spawner.clear_state()
+    assert not spawner.warm_pool_job
+    spawner.warm_pool_size = 0
+    assert spawner.get_warm_pool({"host": "cluster1"}) is None
+
+
+@pytest.mark.asyncio
+async def test_warm_pool_leftovers(db):
+    client_jobs = {"100": "RUNNING", "101": "PENDING", "102": "CANCELLED"}
+    cancelled = []
+
+    class Client:
+        async def job_info(self, system_name):
+            return [{"jobId": int(job_id), "name": "spawner-jupyterhub-pool",
+                     "status": {"state": state}}
+                    for job_id, state in client_jobs.items()] + [
+                {"jobId": 103, "name": "other", "status": {"state": "RUNNING"}}
+            ]
+
+        async def cancel_job(self, system_name, jobid):
+            cancelled.append(jobid)
+
+    async def get_client():
+        return Client()
+
+    # a server restored from the database runs in an allocation of the pool
+    spawner = new_spawner(db=db)
+    spawner.get_firecrest_client_service_account = get_client
+    spawner.load_state({"job_id": "100", "warm_pool_job": True})
+    spawner.warm_pool_size = 1
+
+    async def query_job_status():
+        return JobStatus.RUNNING
+
+    spawner.query_job_status = query_job_status
+
+    assert await spawner.poll() is None
+    task = WarmPool.reconcile(spawner.firecrest_url, "cluster1",
+                              get_client, "spawner-jupyterhub-pool", None)
+    await task
+    # it's only done once
+    assert task is WarmPool.reconcile(spawner.firecrest_url, "cluster1",
+                                      get_client, "spawner-jupyterhub-pool",
+                                      None)
+    assert cancelled == ["101"]
+
+    spawner.clear_state()
+    assert "100" not in WarmPool._handed_over
+
+
+@pytest.mark.asyncio
+async def test_warm_pool_acquire(db):
+    spawner = new_spawner(db=db)
+    spawner.warm_pool_size = 1
+    cancelled = []
+
+    class Client:
+        async def job_info(self, system_name):
+            listing = [{"jobId": int(job_id), "name": "spawner-jupyterhub-pool",
+                        "status": {"state": "RUNNING"}}
+                       for job_id in pool.jobs]
+            # an allocation is submitted while the jobs are listed
+            pool.jobs["101"] = time.monotonic()
+            return listing
+
+        async def cancel_job(self, system_name, jobid):
+            cancelled.append(jobid)
+
+    async def get_client():
+        return Client()
+
+    spawner.get_firecrest_client_service_account = get_client
+    pool = spawner.get_warm_pool({"host": "cluster1"})
+    pool.idle_timeout = 3600
+    submitted = time.monotonic() - 60
+    pool.jobs["100"] = submitted
+
+    assert await pool.acquire() == "100"
+    await pool._maintaining
+    # the allocation submitted during the listing is kept, and the acquired
+    # one isn't cancelled as a leftover
+    assert list(pool.jobs) == ["101"]
+    assert cancelled == []
+
+    # an allocation that couldn't be used keeps its submission time
+    pool.put_back("100")
+    assert pool.jobs["100"] == submitted
+    assert pool.acquired == {}
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker(monkeypatch):
+    breaker = CircuitBreaker.get_breaker("firecrest", failure_threshold=2,
+                                         reset_timeout=30)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+
+    async def request(status_code):
+        if status_code is None:
+            raise httpx.ConnectTimeout("timeout")
+
+        return httpx.Response(status_code)
+
+    assert (await breaker.call(request, 404)).status_code == 404
+    await breaker.call(request, 503)
+    with pytest.raises(httpx.ConnectTimeout):
+        await breaker.call(request, None)
+
+    assert CircuitBreaker.states() == {"firecrest": "open"}
+    with pytest.raises(CircuitOpenError) as e:
+        await breaker.call(request, 200)
+
+    assert e.value.status_code == 503
+    assert e.value.html_message
+
+    def state_metric(state):
+        return REGISTRY.get_sample_value(
+            "firecrestspawner_circuit_breaker_state",
+            {"service": "firecrest", "state": state}
+        )
+
+    assert state_metric("open") == 1
+    assert state_metric("closed") == 0
+
+    # half-open: a single probe is let through
+    now += 30
+    await breaker.call(request, 500)
+    assert breaker.state == "open"
+    now += 30
+    await breaker.call(request, 200)
+    assert breaker.state == "closed"
+    assert state_metric("closed") == 1
+    assert state_metric("open") == state_metric("half-open") == 0
+
+
+@pytest.mark.asyncio
+async def test_client_credentials_auth(auth_server):
+    auth = AsyncClientCredentialsAuth("valid_id", "valid_secret",
+                                      auth_server.url_for("/auth/token"))
+    auth.circuit_breaker = CircuitBreaker.get_breaker("auth",
+                                                      failure_threshold=1)
+    # the token is requested out of the event loop, once for all callers
+    async with fail_on_blocking(0.1):
+        tokens = await asyncio.gather(
+            *[auth.async_get_access_token() for _ in range(5)]
+        )
+
+    assert tokens == ["VALID_TOKEN"] * 5
+    assert count_requests(auth_server, "/auth/token", "POST") == 1
+    assert auth.get_access_token() == "VALID_TOKEN"
+
+    # the authorization server is unreachable
+    auth = AsyncClientCredentialsAuth("valid_id", "valid_secret",
+                                      "http://127.0.0.1:1/auth/token")
+    auth.circuit_breaker = CircuitBreaker.get_breaker("unreachable",
+                                                      failure_threshold=1)
+    with pytest.raises(requests.ConnectionError):
+        await auth.async_get_access_token()
+
+    with pytest.raises(CircuitOpenError):
+        await auth.async_get_access_token()
+
+
+@pytest.mark.asyncio
+async def test_poll_circuit_open(db):
+    spawner = new_spawner(db=db)
+    spawner.job_id = "26"
+    spawner.job_status = "RUNNING nid001"
+
+    async def firecrest_poll():
+        raise CircuitOpenError("firecrest", 10)
+
+    spawner.firecrest_poll = firecrest_poll
+    spawner._access_token_checked = time.monotonic()
+    assert await spawner.poll() is None
+    assert spawner.job_status == "RUNNING nid001"
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_priority():
+    limiter = RateLimiter(rate=20, burst=1, max_in_flight=1)
+    await limiter.acquire()
+    limiter.release()
+    order = []
+
+    async def request(name, high_priority):
+        async with limiter.limit(high_priority):
+            order.append(name)
+
+    # the bucket is empty: the job poll waits and gives way to the submit
+    await asyncio.gather(request("poll", False), request("submit", True))
+    assert order == ["submit", "poll"]
+
+    limiter.pause(0.2)
+    start = time.monotonic()
+    async with limiter.limit():
+        assert limiter.in_flight == 1
+
+    assert time.monotonic() - start >= 0.2
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_retry_after():
+    client = AsyncAuthFirecrest(firecrest_url="https://firecrest.com",
+                                authorization=None)
+    # the rate limit isn't retried by PyFirecREST
+    assert client.num_retries_rate_limit == 0
+    limiter = RateLimiter(rate=0)
+    client.rate_limiters = {"compute": limiter}
+    client.circuit_breaker = CircuitBreaker("firecrest", failure_threshold=1,
+                                            latency_threshold=0.5)
+    responses = [httpx.Response(429, headers={"Retry-After": "1"}),
+                 httpx.Response(200)]
+    in_flight = []
+
+    async def get_request(endpoint):
+        in_flight.append(limiter.in_flight)
+        return responses.pop(0)
+
+    start = time.monotonic()
+    resp = await client._request("GET", get_request,
+                                 endpoint="/compute/cluster1/jobs")
+    assert resp.status_code == 200
+    assert responses == []
+    # the retry waited for the time given by FireCREST without holding
+    # a request slot
+    assert time.monotonic() - start >= 1
+    assert in_flight == [1, 1]
+    assert limiter.in_flight == 0
+    # the wait isn't part of the latency of the requests
+    assert client.circuit_breaker.state == CircuitBreaker.CLOSED
+
+    client.rate_limit_retries = 0
+    responses = [httpx.Response(429, headers={"Retry-After": "5"})]
+    resp = await client._request("GET", get_request,
+                                 endpoint="/compute/cluster1/jobs")
+    assert resp.status_code == 429
+    # the other requests to the group wait for the time given by FireCREST
+    assert limiter.paused_until >= time.monotonic() + 4
+
+
+def test_get_rate_limiters(db):
+    spawner = new_spawner(db=db)
+    # the requests aren't limited by default
+    assert spawner.get_rate_limiters() is None
+
+    spawner.firecrest_rate_limits = {"compute": 5}
+    limiter = spawner.get_rate_limiters()["compute"]
+    assert limiter.rate == 5
+    assert spawner.get_rate_limiters()["compute"] is limiter
+
+    # the limiters follow the changes of the configuration
+    spawner.firecrest_rate_limits = {"compute": 2}
+    assert spawner.get_rate_limiters()["compute"].rate == 2
+    spawner.firecrest_max_in_flight = 1
+    assert spawner.get_rate_limiters()["compute"] is not limiter
+
+
+@pytest.mark.asyncio
+async def test_metrics(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.host = "cluster1"
+    spawner.job_id = "26"
+    spawner._submitted = time.monotonic()
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    requests = sample("firecrestspawner_firecrest_request_duration_seconds_count",
+                      operation="job_info", host="cluster1", outcome="success")
+    refreshes = sample("firecrestspawner_token_refresh_duration_seconds_count",
+                       outcome="success")
+    running = sample("firecrestspawner_jobs", host="cluster1", state="running")
+    waits = sample("firecrestspawner_queue_wait_seconds_count", host="cluster1")
+
+    assert await spawner.query_job_status() == JobStatus.RUNNING
+    assert sample("firecrestspawner_firecrest_request_duration_seconds_count",
+                  operation="job_info", host="cluster1",
+                  outcome="success") == requests + 1
+    assert sample("firecrestspawner_token_refresh_duration_seconds_count",
+                  outcome="success") == refreshes + 1
+    assert sample("firecrestspawner_jobs", host="cluster1",
+                  state="running") == running + 1
+    assert sample("firecrestspawner_queue_wait_seconds_count",
+                  host="cluster1") == waits + 1
+
+    spawner.clear_state()
+    assert sample("firecrestspawner_jobs", host="cluster1",
+                  state="running") == running
+
+
+@pytest.mark.asyncio
+async def test_spawn_timeline(db, caplog):
+    caplog.set_level("INFO")
+    spawner = new_spawner(db=db)
+    spawner.startup_poll_interval = 0.01
+    statuses = [JobStatus.PENDING, JobStatus.RUNNING]
+
+    async def submit_batch_script():
+        spawner.host = "cluster1"
+        spawner.job_id = "26"
+        spawner.record_phase("submitted")
+
+    async def query_job_status():
+        return statuses.pop(0)
+
+    async def state_gethost():
+        return "nid001.cluster1.ch"
+
+    spawner.submit_batch_script = submit_batch_script
+    spawner.query_job_status = query_job_status
+    spawner.state_gethost = state_gethost
+    await spawner.start()
+    assert list(spawner.spawn_timeline) == [
+        "start", "submitted", "pending", "running", "host_resolved"
+    ]
+
+    # a job of a previous spawn doesn't end the timeline
+    apply_spawner_updates(spawner, {"port": 8888, "job_id": "25"},
+                          spawner.log)
+    assert "server_reported" not in spawner.spawn_timeline
+
+    # the single-user server reports its port
+    apply_spawner_updates(spawner, {"port": 8888, "job_id": "26"},
+                          spawner.log)
+    offsets = spawner.spawn_timeline_offsets()
+    assert offsets["start"] == 0
+    assert offsets["server_reported"] >= offsets["host_resolved"]
+    assert caplog.text.count("Spawn timeline") == 1
+
+    # the timeline is logged once
+    apply_spawner_updates(spawner, {"port": 8888}, spawner.log)
+    assert caplog.text.count("Spawn timeline") == 1
+
+    state = spawner.get_state()
+    assert state["spawn_timeline"] == spawner.spawn_timeline
+    spawner.load_state(state)
+    assert spawner.spawn_timeline_offsets() == offsets
+
+
+@pytest.mark.asyncio
+async def test_fail_on_blocking(db):
+    spawner = new_spawner(db=db)
+
+    async def blocking_query_job_status():
+        time.sleep(0.3)
+        return JobStatus.RUNNING
+
+    async def query_job_status():
+        await asyncio.sleep(0.3)
+        return JobStatus.RUNNING
+
+    spawner._access_token_checked = time.monotonic()
+    spawner.job_id = "26"
+    spawner.query_job_status = query_job_status
+    async with fail_on_blocking(0.1) as monitor:
+        assert await spawner.poll() is None
+
+    assert monitor.quantile(0.99) < 0.1
+
+    spawner.query_job_status = blocking_query_job_status
+    with pytest.raises(BlockingCallError) as e:
+        async with fail_on_blocking(0.1):
+            await spawner.poll()
+
+    assert "SlurmSpawner.poll" in str(e.value)
+    assert "time.sleep" in str(e.value) or "blocking_query_job_status" in str(e.value)
+
+
+def test_event_loop_monitor_stalls():
+    monitor = EventLoopMonitor(threshold=0.1, max_stalls=2)
+    for lag in (0.2, 0.3, 0.05, 0.4):
+        monitor.record(lag)
+
+    # only the recent stalls are kept
+    assert [stall.duration for stall in monitor.stalls] == [0.3, 0.4]
+
+
+def test_find_by_api_token(db):
+    spawner = new_spawner(db=db)
+    spawner.api_token = "token-1"
+    assert SlurmSpawner.find_by_api_token("token-1") is spawner
+    spawner.api_token = "token-2"
+    assert SlurmSpawner.find_by_api_token("token-1") is None
+    assert SlurmSpawner.find_by_api_token("token-2") is spawner
+    assert SlurmSpawner.find_by_api_token("") is None
+
+
+def test_apply_spawner_updates(db):
+    spawner = new_spawner(db=db)
+    spawner.job_id = "26"
+    log = spawner.log
+    values = apply_spawner_updates(spawner, [
+        {"port": 8888, "job_id": "26"},
+        {"node_ip": "10.0.0.1", "node_hostname": "nid001", "job_id": 26},
+    ], log)
+    assert values == {"port": 8888, "node_ip": "10.0.0.1",
+                      "node_hostname": "nid001"}
+    assert spawner.port == 8888
+    assert spawner.node_ready.is_set()
+
+    # node reported by the job of a previous spawn
+    spawner.reset_node()
+    apply_spawner_updates(spawner, {"node_hostname": "nid002",
+                                    "job_id": "25"}, log)
+    assert spawner.node_hostname == ""
+
+    with pytest.raises(HTTPError) as e:
+        apply_spawner_updates(spawner, {"cmd": ["rm", "-rf"]}, log)
+    assert e.value.status_code == 400
+
+    # nothing is set if any value is invalid
+    with pytest.raises(HTTPError):
+        apply_spawner_updates(spawner, {"node_hostname": "nid003",
+                                        "port": "not a port"}, log)
+    assert spawner.node_hostname == ""
+    assert spawner.port == 8888
+
+
+def test_report_to_hub(httpserver, monkeypatch):
+    monkeypatch.setenv("JUPYTERHUB_API_URL", httpserver.url_for("/hub/api/"))
+    monkeypatch.setenv("JUPYTERHUB_API_TOKEN", "api-token")
+    monkeypatch.setenv("SLURM_JOB_ID", "26")
+    reports = []
+
+    def handler(request):
+        reports.append(request)
+        if len(reports) == 1:
+            return Response(status=502)
+
+        return Response(status=201)
+
+    httpserver.expect_request(
+        "/hub/api/firecrestspawner", method="POST"
+    ).respond_with_handler(handler)
+
+    assert report_to_hub(8888, retries=2, delay=0.01)
+    assert len(reports) == 2
+    assert reports[-1].headers["Authorization"] == "token api-token"
+    assert reports[-1].json["port"] == 8888
+    assert reports[-1].json["job_id"] == "26"
+
+    # the retries are bounded
+    httpserver.clear()
+    assert not report_to_hub(8888, retries=1, delay=0.01, timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_stop_confirmed_in_background(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.stop_confirm_delay = 0.01
+    spawner.stop_confirm_timeout = 0.05
+    spawner.stop_cancel_retries = 1
+    spawner.host = "cluster1"
+
+    def stop_failures():
+        return REGISTRY.get_sample_value(
+            "firecrestspawner_stop_failures_total", {"host": "cluster1"}
+        ) or 0
+
+    failures = stop_failures()
+
+    # the test server answers 404 for this job once it's cancelled
+    spawner.job_id = "51"
+    await spawner.stop()
+    assert count_requests(fc_server, "/compute/cluster1/jobs/51") == 0
+    confirmations = list(spawner._stop_confirmations)
+    assert await asyncio.gather(*confirmations) == [True]
+    assert not spawner._stop_confirmations
+    assert count_requests(fc_server, "/compute/cluster1/jobs/51",
+                          "DELETE") == 1
+
+    # this job keeps running, so it's cancelled again and reported
+    spawner.job_id = "26"
+    await spawner.stop()
+    assert await asyncio.gather(*spawner._stop_confirmations) == [False]
+    assert count_requests(fc_server, "/compute/cluster1/jobs/26",
+                          "DELETE") == 2
+    assert stop_failures() == failures + 1
+
+
+@pytest.mark.asyncio
+async def test_stop_confirmed_with_batch_polling(db, fc_server, auth_server):
+    spawner = new_spawner(db=db)
+    spawner.firecrest_url = fc_server.url_for("/")
+    spawner.user.authenticator.token_url = "".join([
+        auth_server.url_for("/") ,
+        "auth/realms/kcrealm/protocol/openid-connect/token"
+    ])
+    spawner.stop_confirm_delay = 0.01
+    spawner.stop_confirm_timeout = 0.05
+    spawner.stop_cancel_retries = 0
+    spawner.polling_with_service_account = True
+    spawner.batch_polling = True
+    spawner.get_firecrest_client_service_account = (
+        spawner.get_firecrest_client
+    )
+    spawner.host = "cluster1"
+    spawner.job_id = "26"
+    assert await spawner.query_job_status() == JobStatus.RUNNING
+
+    # JupyterHub clears the state, and the poller forgets the job,
+    # while the job is confirmed
+    await spawner.stop()
+    spawner.clear_state()
+    assert await asyncio.gather(*spawner._stop_confirmations) == [False]
+    assert count_requests(fc_server, "/compute/cluster1/jobs/26") > 0
+
+    # an empty answer doesn't confirm that the job is gone
+    async def job_info(host, job_id):
+        return []
+
+    client = await spawner.get_firecrest_client()
+    client.job_info = job_info
+    assert await spawner.job_is_alive("26", "cluster1") is None
+
+
+@pytest.mark.asyncio
+async def test_cancel_jobs(db, fc_server, auth_server):
+    spawners = []
+    for job_id in ["26", "27", "", "28"]:
+        spawner = new_spawner(db=db)
+        spawner.firecrest_url = fc_server.url_for("/")
+        spawner.user.authenticator.token_url = "".join([
+            auth_server.url_for("/") ,
+            "auth/realms/kcrealm/protocol/openid-connect/token"
+        ])
+        spawner.job_id = job_id
+        spawners.append(spawner)
+
+    # the test server doesn't answer to this FireCREST
+    spawners[-1].firecrest_url = fc_server.url_for("/other/")
+    results = await SlurmSpawner.cancel_jobs(spawners)
+    assert [result["status"] for result in results] == [
+        "cancelled", "cancelled", "no_job", "failed"
+    ]
+    assert results[0]["host"] == "cluster1"
+    assert "error" in results[-1]
+    for job_id in ["26", "27"]:
+        assert count_requests(fc_server, f"/compute/cluster1/jobs/{job_id}",
+                              "DELETE") == 1
+
+    # stopping the servers doesn't cancel the jobs again
+    spawners[0].host = "cluster1"
+    await spawners[0].stop(now=True)
+    assert count_requests(fc_server, "/compute/cluster1/jobs/26",
+                          "DELETE") == 1
+    spawners[0].clear_state()
+    assert spawners[0]._cancelled_job_id is None
+
+
+class MockCancelHandler(FireCRESTSpawnerCancelAPIHandler):
+    """Cancel handler with the request, the authentication and the
+    stopping of the servers done by the test"""
+
+    current_user = None
+    db = None
+    log = logging.getLogger("MockCancelHandler")
+
+    def __init__(self, db, users, scopes, body, failing=()):
+        self.request = SimpleNamespace(path="/hub/api/firecrestspawner/cancel")
+        self.current_user = users["user"]
+        self.db = db
+        self.servers = users
+        self.expanded_scopes = set(scopes)
+        self.parsed_scopes = parse_scopes(scopes)
+        self.body = body
+        self.failing = failing
+        self.stopped = []
+        self.response = None
+
+    def get_json_body(self):
+        return self.body
+
+    def find_user(self, name):
+        return self.servers.get(name)
+
+    async def stop_single_user(self, user, server_name=""):
+        if user.name in self.failing:
+            raise RuntimeError(f"{user.name} is stuck")
+
+        self.stopped.append(user.name)
+
+    def finish(self, chunk):
+        self.response = json.loads(chunk)
+
+
+@pytest.fixture
+def running_servers(db, fc_server, auth_server):
+    """Users ``user`` and ``other``, whose servers run jobs 26 and 27"""
+    db.add(orm.User(name="other"))
+    db.commit()
+    users = {}
+    for name, job_id in [("user", "26"), ("other", "27")]:
+        spawner = new_spawner(db=db, user_name=name)
+        spawner.firecrest_url = fc_server.url_for("/")
+        spawner.user.authenticator.token_url = "".join([
+            auth_server.url_for("/") ,
+            "auth/realms/kcrealm/protocol/openid-connect/token"
+        ])
+        spawner.host = "cluster1"
+        spawner.job_id = job_id
+        spawner.orm_spawner.server = orm.Server()
+        spawner.user.spawners[""] = spawner
+        users[name] = spawner.user
+
+    db.commit()
+    return users
+
+
+@pytest.mark.asyncio
+async def test_cancel_handler_scopes(db, fc_server, running_servers):
+    handler = MockCancelHandler(
+        db, running_servers, ["servers!user=user"],
+        {"servers": ["user", "other", "ghost", "user/missing"]}
+    )
+    await handler.post()
+    assert handler.stopped == ["user"]
+    # no difference between missing servers and missing permissions
+    assert handler.response["servers"] == [
+        {"user": "other", "server": "", "status": "not_found"},
+        {"user": "ghost", "server": "", "status": "not_found"},
+        {"user": "user", "server": "missing", "status": "not_found"},
+        {"user": "user", "server": "", "job_id": "26", "host": "cluster1",
+         "status": "cancelled"},
+    ]
+    assert handler.response["summary"] == {"not_found": 3, "cancelled": 1}
+    assert count_requests(fc_server, "/compute/cluster1/jobs/26",
+                          "DELETE") == 1
+    assert count_requests(fc_server, "/compute/cluster1/jobs/27",
+                          "DELETE") == 0
+
+    handler = MockCancelHandler(db, running_servers, ["servers"],
+                                {"servers": "user"})
+    with pytest.raises(HTTPError) as e:
+        await handler.post()
+
+    assert e.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_cancel_handler_stop_failures(db, fc_server, running_servers):
+    handler = MockCancelHandler(db, running_servers, ["servers"],
+                                {"servers": ["user", "other"]},
+                                failing={"other"})
+    await handler.post()
+    assert handler.stopped == ["user"]
+    results = {result["user"]: result
+               for result in handler.response["servers"]}
+    assert results["user"]["status"] == "cancelled"
+    assert results["other"]["status"] == "stop_failed"
+    assert results["other"]["error"] == "other is stuck"
+    assert handler.response["summary"] == {"cancelled": 1, "stop_failed": 1}
+
+
+@pytest.mark.asyncio
+async def test_cancel_handler_cancel_failures(db, fc_server, running_servers):
+    # the test server doesn't answer to this FireCREST
+    running_servers["other"].spawners[""].firecrest_url = fc_server.url_for(
+        "/other/"
+    )
+    handler = MockCancelHandler(db, running_servers, ["servers"],
+                                {"servers": ["user", "other"]})
+    await handler.post()
+    # the server whose job couldn't be cancelled isn't stopped
+    assert handler.stopped == ["user"]
+    results = {result["user"]: result
+               for result in handler.response["servers"]}
+    assert results["other"]["status"] == "failed"
+    assert "error" in results["other"]
+    assert handler.response["summary"] == {"cancelled": 1, "failed": 1}